@@ -1,41 +1,51 @@
 import time
+import base64
 import requests
 import plexapi
 import shutil
 import os
 import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import threading
+import itertools
+import queue
+import tempfile
 from utils import *
+from cache import ArtCache, ProbeCache, TranscodeCache, get_default_cache_dir, load_probe_cache
+from manifest import DirectoryListings, SyncManifest
+from journal import SyncJournal
+from tracks import PlaylistItem, TrackList, TrackTable
+from pipeline import Stage, drain
+from metrics import Metrics, run_profiled, write_report
+from playlists import PLAYLIST_FORMATS, get_playlist_folders, render_playlists
+from plan import SyncPlan, ACTION_COPY, ACTION_CONVERT, ACTION_KEEP
+from transcode import Transcoder, TranscodeProfile
+from copy_engine import CopyEngine, FSYNC_NONE
+from filesystem import LocalFileSystem, get_file_system, is_smb_url
 from plexapi.server import PlexServer
 from mutagen.mp3 import MP3
 from mutagen.flac import FLAC
 from mutagen.mp4 import MP4
 from mutagen.id3 import ID3, APIC
 from mutagen.mp4 import MP4Cover
-
-class PlaylistItem:
-    def __init__(self, 
-        title: str,
-        duration: int,
-        plexPath: str,
-        fsPath: str,
-        outPath: str,
-        playlistRelPath: str,
-        playlistAbsPath: str
-    ):
-        # title is also used as filename, filter some characters
-        # why title = filename? Because some players display the filename instead of reading the id3 tag...
-        self.title = title.replace(':', '_').replace('/', '_').replace('?', '')
-        self.duration = duration / 1000 # conv to seconds
-        self.plexPath = plexPath    # Path to music dir as known to plex, on your server, could be in docker or smth
-        self.fsPath = fsPath    # Path to music dir as known to the filesystem, this could be different from plex.
-        self.outPath = rename_filename_keep_extension(outPath, self.title)  # Path to music dir where the music should be copied to.
-        self.playlistRelPath = playlistRelPath # from the perspective of the playlist, path to the music dir
-        self.playlistAbsPath = playlistAbsPath  # from the root dir, path to the music dirs
+from mutagen.oggopus import OggOpus
+from mutagen.flac import Picture
 
 MUSIC_FOLDER_OUT_DIR = "Music"
 REL_PATH_FOR_PLAYLIST = "../" + MUSIC_FOLDER_OUT_DIR
 ABS_PATH_FOR_PLAYLIST = "/" + MUSIC_FOLDER_OUT_DIR
 
+PLEX_PAGE_SIZE = 500
+
+# Create a plex connection that can run `jobs` requests at the same time over reused connections
+def connect_plex(host: str, token: str, jobs: int):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(jobs, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return PlexServer(host, token, session=session)
+
 # Get all audio playlists on the plex server of the user
 def get_playlists(plex: PlexServer, filtered_playlists):
     print('Searching for playlists... ', end='')
@@ -44,254 +54,1026 @@ def get_playlists(plex: PlexServer, filtered_playlists):
     result = []
     for item in playlists:
         if (item.playlistType == 'audio' and item.title not in filtered_playlists):
-            result.append(item.title)
+            result.append(item)
 
     print('Found %d' % len(result))
     return result
 
-# Ge tall the items in a playlist, in a trimmed down format
-def get_playlist_items(plex: PlexServer, name: str, plexMusicRoot: str, fsMusicRoot: str, outDir: str):
-    try:
-        playlist = plex.playlist(name)
-    except (plexapi.exceptions.NotFound):
+# Get a page of playlist items as raw xml, so no plexapi objects are built for fields we do not use
+def get_playlist_page(plex: PlexServer, playlist, start: int):
+    return plex.query(
+        '%s/items' % playlist.key,
+        params={'X-Plex-Container-Start': start, 'X-Plex-Container-Size': PLEX_PAGE_SIZE},
+    )
+
+# The table all playlist items of a sync are stored in, with the paths derived from the plex file path
+def create_track_table(plexMusicRoot: str, fsMusicRoot: str, outDir: str):
+    return TrackTable(
+        plexMusicRoot,
+        fsMusicRoot,
+        os.path.join(outDir, MUSIC_FOLDER_OUT_DIR),
+        REL_PATH_FOR_PLAYLIST,
+        ABS_PATH_FOR_PLAYLIST,
+    )
+
+# Add a track element of a playlist page to tracks, only reading the fields we need. Returns its row.
+def parse_playlist_item(element, tracks: TrackTable):
+    part = element.find('Media/Part')
+    if part is None or not part.attrib.get('file'):
         return None
 
-    items = playlist.items()
-    parsed_items = []
-    for item in items:
-        plexFile = item.media[0].parts[0].file
-        parsed_items.append(
-            PlaylistItem(
-                item.title,
-                item.duration,
-                plexFile,
-                plexFile.replace(plexMusicRoot, fsMusicRoot),
-                plexFile.replace(plexMusicRoot, os.path.join(outDir, MUSIC_FOLDER_OUT_DIR)),
-                plexFile.replace(plexMusicRoot, REL_PATH_FOR_PLAYLIST),
-                plexFile.replace(plexMusicRoot, ABS_PATH_FOR_PLAYLIST),
-            )
+    return tracks.add(
+        element.attrib.get('title', ''),
+        int(element.attrib.get('duration', 0)),
+        part.attrib['file'],
+        element.attrib.get('ratingKey'),
+        element.attrib.get('updatedAt'),
+        fetched=True,
+    )
+
+# Plex updates these when a playlist is edited, so items only need to be fetched again if this changes
+def get_playlist_fingerprint(playlist):
+    updatedAt = int(playlist.updatedAt.timestamp()) if playlist.updatedAt else None
+    return '%s:%s:%s' % (updatedAt, playlist.leafCount, playlist.duration)
+
+# The plex fields of a PlaylistItem, as stored in the manifest for unchanged playlists
+def get_playlist_item_state(item: PlaylistItem):
+    return [item.title, int(round(item.duration * 1000)), item.plexPath, item.ratingKey, item.updatedAt]
+
+def get_page_count(playlist):
+    return max((playlist.leafCount or 0) + PLEX_PAGE_SIZE - 1, PLEX_PAGE_SIZE) // PLEX_PAGE_SIZE
+
+# Get all the items of the given playlists, in a trimmed down format
+# All pages of all playlists are fetched concurrently by `jobs` workers.
+# Yields a TrackList of rows in tracks per playlist in the same order as playlists, as soon as all its pages are in.
+# Yields None for playlists that could not be fetched.
+def get_playlist_items(plex: PlexServer, playlists: list, tracks: TrackTable, jobs: int = 1, metrics: Metrics = None):
+    metrics = metrics or Metrics()
+
+    def fetch(page):
+        playlist, start = page
+        try:
+            with metrics.timed("plex page"):
+                return get_playlist_page(plex, playlist, start)
+        except (plexapi.exceptions.NotFound, plexapi.exceptions.BadRequest):
+            return None
+
+    pages = [
+        (playlist, page * PLEX_PAGE_SIZE)
+        for playlist in playlists
+        for page in range(get_page_count(playlist))
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        containers = executor.map(fetch, pages)
+        for playlist in playlists:
+            playlist_elements = []
+            for _ in range(get_page_count(playlist)):
+                container = next(containers)
+                if container is None or playlist_elements is None:
+                    playlist_elements = None
+                    continue
+                playlist_elements.extend(container)
+
+            # The playlist could have grown since it was listed, fetch whatever is left
+            while playlist_elements and len(playlist_elements) % PLEX_PAGE_SIZE == 0:
+                container = fetch((playlist, len(playlist_elements)))
+                if container is None or not len(container):   # the request failed, or no more items
+                    break
+                playlist_elements.extend(container)
+
+            if playlist_elements is None:
+                yield None
+                continue
+
+            parsed_items = TrackList(tracks)
+            for element in playlist_elements:
+                row = parse_playlist_item(element, tracks)
+                if row is not None:
+                    parsed_items.append(row)
+            yield parsed_items
+
+TRANSCODE_COPY = "copy"
+TRANSCODE_FAILED = "failed"
+
+# What parse_album_art_audiofile found, shown in the progress line of the file
+ALBUM_ART_CONVERTED = "album art converted"
+ALBUM_ART_MISSING = "no album art"
+ALBUM_ART_WAV = "no album art in WAV files"
+
+# The status of a file with the note of its album art check added, the note alone if the file was not written
+def add_album_art_note(status: str, note: str):
+    if note is None:
+        return status
+    return '%s (%s)' % (status, note) if status is not None else note[:1].upper() + note[1:]
+
+# An out dir that a sync writes to, with its own config, manifest and journal.
+# One run can sync to several, every source file is then read and converted once and written to all of them.
+class SyncTarget:
+    def __init__(self, outDir: str, config: Config, copyEngine: CopyEngine = None, fileSystem = None, cache: ProbeCache = None):
+        self.outDir = outDir
+        self.config = config
+        self.musicDir = os.path.join(outDir, MUSIC_FOLDER_OUT_DIR)
+        self.fileSystem = fileSystem or LocalFileSystem()   # where outPath is written to
+        self.copyEngine = copyEngine or CopyEngine(COPY_BUFFER_SIZE, target=self.fileSystem)
+        self.listings = DirectoryListings(self.fileSystem)   # one scandir per album folder on the output device
+        self.manifest = SyncManifest(outDir)
+        self.journal = SyncJournal(outDir)  # only written to once it is opened, after the plan is checked
+        self.cache = cache or load_probe_cache(outDir)  # album art verdicts of the files in this out dir
+        self.checkAlbumArt = not config.skip_album_art_checks
+        self.profile = TranscodeProfile.from_config(config)  # what the files are converted to for this device
+        self.index = 0  # of the target in SyncState.targets, and of its file in SyncTask.files
+        self.label = ""  # prefix of its output lines, if there are several targets
+
+# Everything the pipeline workers share during a sync
+class SyncState:
+    def __init__(self,
+        cache: ProbeCache,
+        targets: list[SyncTarget],
+        warnLossy: bool,
+        fastProbe: bool,
+        transcoder: Transcoder,
+        artCache: ArtCache = None,
+        artProcesses: concurrent.futures.ProcessPoolExecutor = None,
+        copyEngine: CopyEngine = None,
+        readAhead: int = 0,
+        source = None,
+        metrics: Metrics = None,
+    ):
+        self.cache = cache
+        self.artCache = artCache or ArtCache()
+        self.artProcesses = artProcesses    # None to check album art on the pipeline threads
+        self.warnLossy = warnLossy
+        self.fastProbe = fastProbe
+        self.transcoder = transcoder
+        self.source = source or LocalFileSystem()   # where fsPath is read from, the OS or the SMB client
+        self.copyEngine = copyEngine or CopyEngine(COPY_BUFFER_SIZE)    # reads ahead from the source for all targets
+        self.readAhead = readAhead  # files read ahead from the share into local staging, 0 to read them while copying
+        self.sourceListings = DirectoryListings(self.source)   # one scandir per album folder on the share
+        self.metrics = metrics or Metrics()
+        self.set_targets(targets)
+
+    def set_targets(self, targets: list[SyncTarget]):
+        """The targets the pipeline writes to. Targets that are dropped keep the index of their file in the tasks."""
+        self.targets = targets
+        for target in targets:
+            target.label = "[%s] " % target.outDir if len(targets) > 1 else ""
+
+# The output file of a track on one target
+class TargetFile:
+    def __init__(self, outPath: str):
+        self.outPath = outPath
+        self.needsSync = False
+        self.transcode = None   # TRANSCODE_COPY, or the name of the profile it is converted to
+        self.status = None  # stays None if the file was already up to date
+        self.failed = False
+        self.bytesWritten = 0
+        self.artChecked = 0  # the cover size the album art was checked for
+
+    def fail(self, e: Exception):
+        self.status = 'Error: %s' % e
+        self.failed = True
+
+# A unique track on its way through the sync pipeline, every stage adds what it found out
+class SyncTask:
+    def __init__(self, index: int, item: PlaylistItem, files: list[TargetFile]):
+        self.index = index
+        self.item = item
+        self.files = files  # one per target, in the order of SyncState.targets
+        self.srcStat = None
+        self.probe = None
+        self.bitDepth = None
+        self.readPath = None    # local copy of the source, if it was read ahead
+        self.readHash = None
+        self.converted = {}  # profile name -> (path, hash) of the converted file in local staging, for every target with that profile
+        self.artFixed = {}  # art_key -> local copy with fixed album art, or None if the album art was fine
+        self.artNotes = {}  # art_key -> what the album art check found, see parse_album_art_audiofile
+        self.errors = []
+        self.failed = False
+
+    @property
+    def needsSync(self):
+        return not self.failed and any(file.needsSync for file in self.files)
+
+    def profiles(self, targets: list):
+        """The profiles the file is converted to for the targets it is synced to, by name."""
+        return {
+            target.profile.name: target.profile for target in targets
+            if self.files[target.index].needsSync and self.files[target.index].transcode != TRANSCODE_COPY
+        }
+
+    def copies(self):
+        """The amount of targets the source is copied to as it is."""
+        return sum(file.needsSync and file.transcode == TRANSCODE_COPY for file in self.files)
+
+    def art_key(self, target):
+        """What the file of target is copied from and the cover size of target, all targets with the same key get the
+        same album art. The source is copied as it is if the conversion failed."""
+        transcode = self.files[target.index].transcode
+        if transcode == TRANSCODE_COPY or self.converted.get(transcode, (None, None))[0] is None:
+            return (TRANSCODE_COPY, target.profile.coverSize)
+        return (transcode, target.profile.coverSize)
+
+    def fail(self, e: Exception):
+        self.errors.append(e)
+        self.failed = True
+        for file in self.files:
+            file.fail(e)
+
+# Pipeline stage: find the source file, probe it and decide whether it has to be synced to each target.
+# Deciding it here means the read ahead stage only reads the files that are actually copied.
+def probe_task(task: SyncTask, state: SyncState):
+    value = task.item
+    try:
+        task.srcStat = state.sourceListings.stat(value.fsPath)
+        if task.srcStat is None:
+            raise FileNotFoundError(f"Source file does not exist: {value.fsPath}")
+
+        with state.metrics.timed("probe"):
+            task.probe = state.cache.probe(value.fsPath, state.fastProbe, task.srcStat, state.source)
+        task.bitDepth = task.probe.bit_depth
+        if task.bitDepth is None and state.warnLossy is True:
+            task.errors.append('Could not determine bit depth (could be lossy mp3/m4a/ogg?) File: %s' % value.fsPath)
+
+        for target in state.targets:
+            file = task.files[target.index]
+            file.needsSync = True
+            file.outPath = target.profile.output_path(file.outPath, task.probe)    # ALAC has the extension of AAC, so after the probe
+            file.transcode = target.profile.name if target.profile.needs_transcode(task.probe, value.fsPath) else TRANSCODE_COPY
+
+            dst_stat = target.listings.stat(file.outPath)
+            if dst_stat is not None:   # the Music folder was listed by the scan, no stat of its own
+                if target.manifest.is_up_to_date(file.outPath, value.fsPath, task.srcStat, file.transcode):
+                    file.needsSync = False
+
+                # Synced before there was a manifest, trust the modification time like before and adopt it.
+                elif dst_stat is not None and not target.manifest.has_file(file.outPath) \
+                    and int(task.srcStat.st_mtime // 60) <= int(dst_stat.st_mtime // 60):
+                    target.manifest.record(file.outPath, value.fsPath, task.srcStat, file.transcode, None)
+                    file.needsSync = False
+    except Exception as e:
+        task.fail(e)
+    return task
+
+# Pipeline stage: read the source from the share into local staging, while earlier files are still being written.
+# Local sources are left alone, those are copied by the kernel.
+def read_task(task: SyncTask, state: SyncState):
+    if not task.needsSync or not state.source.is_remote(task.item.fsPath):
+        return task
+    if not task.copies() and all(
+        state.transcoder.has_cached(task.item.fsPath, task.srcStat, profile, task.probe) for profile in task.profiles(state.targets).values()
+    ):
+        return task
+
+    try:
+        with state.metrics.timed("read ahead"):
+            task.readPath, task.readHash = state.copyEngine.prefetch(task.item.fsPath, state.source)
+        state.metrics.count("bytes read ahead", task.srcStat.st_size)
+    except Exception as e:
+        task.errors.append('Could not read ahead, reading it while copying instead: %s' % e)
+    return task
+
+# Pipeline stage: convert the file in local staging, once per profile for all targets with that profile, and fix the
+# album art of what is copied to the targets that check album art, before it is copied.
+# A file on the share that is not read ahead yet is read here if it is read more than once, so it is read only once.
+def convert_task(task: SyncTask, state: SyncState):
+    if not task.needsSync:
+        return task
+
+    value = task.item
+    try:
+        profiles = task.profiles(state.targets)
+        converts = not all(state.transcoder.has_cached(value.fsPath, task.srcStat, profile, task.probe) for profile in profiles.values())
+        art_copies = any(
+            target.checkAlbumArt and task.files[target.index].needsSync and task.files[target.index].transcode == TRANSCODE_COPY
+            for target in state.targets
         )
+        if task.readPath is None and (
+            ((converts or art_copies) and not state.source.is_local(value.fsPath))   # ffmpeg and mutagen need a local file
+            or ((task.copies() + converts > 1 or art_copies) and state.source.is_remote(value.fsPath))
+        ):
+            with state.metrics.timed("read ahead"):
+                task.readPath, task.readHash = state.copyEngine.prefetch(value.fsPath, state.source)
 
-    return parsed_items
-
-# Create a simple m3u playlist with the absolute path to the files
-# Peugeot infotainment systems want these, and Rockbox ignores them. winwin?
-def create_m3u_simple_abstract(
-    playlistTitle: str, 
-    playlistItems: list[PlaylistItem],
-    playlistDir: str,
-):
-    playlistPath = "%s/%s.m3u" % (playlistDir, playlistTitle)
-    if not os.path.exists(playlistDir):
-        os.makedirs(playlistDir)
-
-    m3u = open(playlistPath, 'w', encoding="utf-8")
-    for item in playlistItems:
-        fs_path = rename_filename_keep_extension(item.playlistAbsPath, item.title)
-        m3u.write("%s\n" % fs_path)
-
-    m3u.close()
-
-# Create an m3u8 playlist with the relative path to the files and extended info.
-# Main format for most players, like RockBox and Mazda Connect.
-def create_m3u8_extended_relative(
-    playlistTitle: str, 
-    playlistItems: list[PlaylistItem],
-    playlistDir: str,   
-):
-    playlistPath = "%s/%s.m3u8" % (playlistDir, playlistTitle)
-    if not os.path.exists(playlistDir):
-        os.makedirs(playlistDir)
-
-    m3u = open(playlistPath, 'w', encoding="utf-8")
-    m3u.write('#EXTM3U\n')
-    m3u.write('#PLAYLIST:%s\n' % playlistTitle)
-    m3u.write('\n')
-
-    for item in playlistItems:
-        fs_path = rename_filename_keep_extension(item.playlistRelPath, item.title)
-        m3u.write('#EXTINF:%s,%s\n' % (int(item.duration), item.title))
-        m3u.write("%s\n" % fs_path)
-        m3u.write("\n")
-
-    m3u.close()
-
-# Copies all playlist files, using fsPath and outPath for each PlaylistItem
-def copy_files(playlistItems: list[PlaylistItem], warnLossy: False):
-    errors = []
+        for name, profile in profiles.items():
+            with state.metrics.timed("convert"):
+                task.converted[name] = state.transcoder.transcode(value.fsPath, profile, task.probe, task.srcStat, task.readPath)
+            if task.converted[name][0] is None:
+                task.errors.append('Failed to convert to %s: %s' % (name, value.fsPath))
+    except Exception as e:
+        task.fail(e)
+        return task
 
-    for i, value in enumerate(playlistItems):
-        bit_depth = get_bit_depth(value.fsPath)
-        index = "[%i/%i][%sbit] %s..." % (i+1, len(playlistItems), bit_depth, value.title)
-        if bit_depth is None and warnLossy is True:
-            errors.append('Could not determine bit depth (could be lossy mp3/m4a/ogg?) File: %s' % value.fsPath);
+    for target in state.targets:
+        if target.checkAlbumArt and task.files[target.index].needsSync:
+            fix_album_art(task, state, target)
+    return task
 
+# Fix the album art of what is copied to target on a local copy, once for all targets with the same art_key.
+# Encoded files got a cover of the right size when they were encoded. A failed check is reported and the file is
+# copied as it is, it is checked on the device by the next run.
+def fix_album_art(task: SyncTask, state: SyncState, target: SyncTarget):
+    key = task.art_key(target)
+    if key in task.artFixed:
+        return
+    transcode, coverSize = key
+    if transcode != TRANSCODE_COPY and target.profile.lossy:
+        task.artFixed[key] = None
+        return
+
+    path = task.converted[transcode][0] if transcode != TRANSCODE_COPY else task.readPath or task.item.fsPath
+    fixed_path = None
+    try:
+        fd, fixed_path = tempfile.mkstemp(dir=state.transcoder.stagingDir, suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        with state.metrics.timed("album art"):
+            task.artNotes[key] = check_album_art(path, state, coverSize, fixed_path)
+        rewritten = task.artNotes[key] == ALBUM_ART_CONVERTED
+        if not rewritten:
+            state.transcoder.release(fixed_path)
+    except Exception as e:
         try:
-            if should_copy_file_if_newer(value.fsPath, value.outPath): 
-                if bit_depth is not None and bit_depth > 16:
-                    print(index, end='', flush=True)
-                    convert_to_16bit(value.fsPath, value.outPath)
-                    if get_bit_depth(value.outPath) != 16:
-                        print(' Copied but could not convert.')
-                        errors.append('Failed to convert to 16bit: %s'  % value.fsPath)
-                    else:
-                        print(' Converted & Copied')
-                else:
-                    print(index, end='', flush=True)
-                    copy_file_if_newer(value.fsPath, value.outPath)
-                    print(' Copied')
-        except Exception as e:
-            print('%s Error: %s' % (index, e))
-            errors.append(e)
+            state.transcoder.release(fixed_path)
+        except OSError:
+            pass    # the staging dir is gone, so is the file
+        task.errors.append(f"Could not process album art of {task.item.fsPath}: {e}")
+        return
+    if rewritten:
+        state.metrics.count("album art rewritten")
+    task.artFixed[key] = fixed_path if rewritten else None
+
+# Pipeline stage: copy the local copy with fixed album art, the converted file, or the source from fsPath, to the outPath on one target.
+# Every target has its own copy stage, so the devices are written at the same time.
+# The last one removes the local copies of the file.
+def copy_task(task: SyncTask, state: SyncState, target: SyncTarget):
+    file = task.files[target.index]
+    value = task.item
+    try:
+        if not task.needsSync or not file.needsSync:
+            return task
+
+        transcode = file.transcode
+        converted_path, converted_hash = task.converted.get(transcode, (None, None))
+        if converted_path is None and transcode != TRANSCODE_COPY and target.profile.output_path(value.fsPath, task.probe) != value.fsPath:
+            raise ValueError('Could not convert to %s, the source cannot be copied as is' % transcode)
+
+        art_key = task.art_key(target)
+        art_checked = target.checkAlbumArt and art_key in task.artFixed
+        fixed_path = task.artFixed.get(art_key) if art_checked else None
+        target.journal.started(file.outPath, value.fsPath)
+        with state.metrics.timed("copy"):
+            if fixed_path is not None:
+                out_hash = target.copyEngine.copy(fixed_path, file.outPath, task.srcStat)  # hashed while it is copied
+            elif converted_path is not None:
+                out_hash = target.copyEngine.copy(converted_path, file.outPath, task.srcStat, converted_hash)
+            elif task.readPath is not None:
+                out_hash = target.copyEngine.copy(task.readPath, file.outPath, task.srcStat, task.readHash)
+            else:
+                out_hash = target.copyEngine.copy(value.fsPath, file.outPath, task.srcStat, None, state.source)
+            if converted_path is not None:
+                file.status = 'Converted & Copied'
+            elif transcode != TRANSCODE_COPY:
+                transcode = TRANSCODE_FAILED    # never matches, so it is retried next run
+                file.status = 'Copied but could not convert.'
+            else:
+                file.status = 'Copied'
+            if art_checked:
+                file.status = add_album_art_note(file.status, task.artNotes.get(art_key))
+
+        target.manifest.record(file.outPath, value.fsPath, task.srcStat, transcode, out_hash)
+        if art_checked:
+            target.cache.set_art_ok(file.outPath, os.stat(file.outPath), target.profile.coverSize)
+            file.artChecked = target.profile.coverSize
+        file.bytesWritten = os.path.getsize(file.outPath)
+        state.metrics.count("files written")
+        state.metrics.count("bytes written", file.bytesWritten)
+    except Exception as e:
+        task.errors.append('%s%s' % (target.label, e))
+        file.fail(e)
+    finally:
+        if target is state.targets[-1]:
+            try:
+                state.copyEngine.release(task.readPath)
+                for converted_path, _ in task.converted.values():
+                    state.transcoder.release(converted_path)
+                for fixed_path in task.artFixed.values():
+                    state.transcoder.release(fixed_path)
+            except OSError as e:
+                task.errors.append('Could not remove the local copies of %s: %s' % (value.fsPath, e))
+            task.readPath = None
+            task.converted = {}
+            task.artFixed = {}
+            task.artNotes = {}
+    return task
+
+# Every album art process has its own ArtCache, they only share the one on disk
+process_art_cache = None
+
+def init_album_art_process(cacheDir: str):
+    global process_art_cache
+    process_art_cache = ArtCache(cache_dir=cacheDir)
+
+def parse_album_art_audiofile_in_process(filepath, coverSize = MAX_SIZE, outputPath = None):
+    return parse_album_art_audiofile(filepath, process_art_cache, coverSize, outputPath)
+
+# Album art is mostly PIL and mutagen work that holds the GIL, so with more than a few threads it is
+# faster to do it in processes. Only the path goes to the process and only a short note comes back.
+# Returns None if processes cannot be started here, then the pipeline threads do the work instead.
+def create_album_art_process_pool(jobs: int, cacheDir: str = None):
+    try:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(jobs, 1),
+            initializer=init_album_art_process,
+            initargs=(cacheDir,),
+            mp_context=multiprocessing.get_context('spawn'),  # forking while the pipeline threads run is not safe
+        )
+    except (OSError, NotImplementedError, ImportError) as e:
+        print('Could not start album art processes, using threads instead: %s' % e)
+        return None
+
+# Make the album art of a file a baseline jpeg of at most coverSize, in a process if there is a pool for that.
+# With outputPath, the file with new album art is saved there instead. See parse_album_art_audiofile
+def check_album_art(filepath: str, state: SyncState, coverSize: int = MAX_SIZE, outputPath: str = None):
+    if state.artProcesses is not None:
+        try:
+            return state.artProcesses.submit(parse_album_art_audiofile_in_process, filepath, coverSize, outputPath).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            state.artProcesses = None
+    return parse_album_art_audiofile(filepath, state.artCache, coverSize, outputPath)
+
+# Pipeline stage: make the album art of the output files that were not written by this run a baseline jpeg, on the
+# targets that check album art, of at most the cover size of their profile, if the cache has no verdict for them at
+# that size yet. Those are rewritten on the device, the files this run writes had their album art fixed before the copy.
+def album_art_task(task: SyncTask, state: SyncState):
+    if task.failed:
+        return task
+
+    for target in state.targets:
+        file = task.files[target.index]
+        if not target.checkAlbumArt or file.failed or file.needsSync:
             continue
-    
+        try:
+            dst_stat = target.listings.stat(file.outPath) or os.stat(file.outPath)
+            if target.cache.get_art_ok(file.outPath, dst_stat, target.profile.coverSize):
+                continue
+
+            with state.metrics.timed("album art"):
+                note = check_album_art(file.outPath, state, target.profile.coverSize)
+            file.status = add_album_art_note(file.status, note)
+            if note == ALBUM_ART_CONVERTED:
+                state.metrics.count("album art rewritten")
+                target.manifest.update_hash(file.outPath, hash_file(file.outPath))
+            target.cache.set_art_ok(file.outPath, os.stat(file.outPath), target.profile.coverSize)
+        except Exception as e:
+            task.errors.append(f"Could not process album art of {file.outPath}: {e}")
+    return task
+
+# The func of a pipeline Stage for a stage function. Whatever it raises fails the task, so the task still moves on
+# to the next stage, a worker that died would never pass on DONE and the sync would hang.
+def stage_func(name: str, func, state: SyncState, *args):
+    def run(task):
+        try:
+            return func(task, state, *args)
+        except Exception as e:
+            task.fail(e)
+            return task
+    return state.metrics.wrap("stage %s" % name, run)
+
+# Dedupes and probes the tracks of all playlists, while later playlists are still being fetched from plex.
+# Tracks that are in multiple playlists only need to be synced once, keep the first occurrence of every outPath.
+# Returns the tasks in playlist order, and how many times they were referenced by playlists in total.
+def probe_files(playlistsItems, state: SyncState, jobs: int = 1):
+    counts = {"unique": 0, "references": 0}
+    producer_errors = []
+    maxsize = max(jobs, 1) * 4
+
+    results = queue.Queue(maxsize)
+    probe = Stage("probe", stage_func("probe", probe_task, state), jobs, results, maxsize).start()
+
+    def produce():
+        seen_rows = set()
+        seen = set()
+        try:
+            for playlist_items in playlistsItems:
+                for item in playlist_items:
+                    counts["references"] += 1
+                    if item.row in seen_rows:
+                        continue
+                    seen_rows.add(item.row)
+                    if item.outPath in seen:    # a different file, with the same title in the same folder
+                        continue
+                    seen.add(item.outPath)
+                    counts["unique"] += 1
+                    files = [TargetFile(item.tracks.renamed_path(item.row, target.musicDir)) for target in state.targets]
+                    probe.put(SyncTask(counts["unique"] - 1, item, files))
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            probe.close()
+
+    producer = threading.Thread(target=produce, name="plex", daemon=True)
+    producer.start()
+    tasks = sorted(drain(results), key=lambda task: task.index)
+    producer.join()
+    if producer_errors:
+        raise producer_errors[0]
+    return tasks, counts["references"]
+
+# Works out what syncing the probed tasks does to the Music folder of target, before anything is written.
+# existingFiles is a scan of the Music folder. Failed tasks keep their output file, it is not an orphan.
+# Orphans are only looked for with findOrphans, and if the tracks are in the Music folder at all: if they
+# are not, fs-music-root or plex-music-root is off and every file would look like an orphan.
+def plan_sync(tasks: list[SyncTask], target: SyncTarget, existingFiles: dict, findOrphans: bool = True):
+    plan = SyncPlan(target.musicDir, existingFiles)
+    for task in tasks:
+        file = task.files[target.index]
+        if task.failed or not file.needsSync:
+            plan.add_file(file.outPath, ACTION_KEEP)
+        elif file.transcode != TRANSCODE_COPY:
+            plan.add_file(file.outPath, ACTION_CONVERT, target.profile.estimate_size(task.srcStat.st_size, task.probe))
+        else:
+            plan.add_file(file.outPath, ACTION_COPY, task.srcStat.st_size)
+    wanted = {task.files[target.index].outPath for task in tasks}
+    if findOrphans and any(path.startswith(target.musicDir + os.sep) for path in wanted):
+        plan.find_orphans(wanted)
+    return plan
+
+# Syncs probed tasks as a pipeline: read ahead -> convert and fix album art -> copy to every target -> album art of the files it did not write.
+# Every stage has its own workers and a bounded queue, so the stages run at the same time.
+# The convert stage has enough workers for `transcode-jobs` conversions at the same time, even above `jobs`.
+# Its inbox holds state.readAhead files, which limits how many are read ahead into local staging.
+# The copy stages only hold a file per worker on top of that, files read ahead are removed after the last one.
+# Output and errors are reported in playlist order, regardless of which worker finishes first.
+def sync_files(tasks: list[SyncTask], state: SyncState, jobs: int = 1, artJobs: int = 4, references: int = None):
+    errors = []
+    bytes_written = 0
+    start_time = time.time()
+    maxsize = max(jobs, 1) * 4
+
+    results = queue.Queue(maxsize)
+    check_album_art = any(target.checkAlbumArt for target in state.targets)
+    art = Stage("art", stage_func("art", album_art_task, state), artJobs, results, maxsize).start() if check_album_art else None
+    next_inbox = art.inbox if art else results
+    for target in reversed(state.targets):
+        name = "copy" if len(state.targets) == 1 else "copy %i" % (target.index + 1)
+        copy = Stage(name, stage_func("copy", copy_task, state, target), jobs, next_inbox, max(jobs, 1)).start()
+        next_inbox = copy.inbox
+    convert_jobs = max(jobs, state.transcoder.jobs)
+    convert = Stage("convert", stage_func("convert", convert_task, state), convert_jobs, next_inbox, state.readAhead or maxsize).start()
+    read = Stage("read", stage_func("read", read_task, state), jobs, convert.inbox, maxsize).start() if state.readAhead > 0 else None
+    first = read or convert
+
+    def produce():
+        for task in tasks:
+            first.put(task)
+        first.close()
+
+    producer = threading.Thread(target=produce, name="tasks", daemon=True)
+    producer.start()
+
+    pending = {}
+    next_index = 0
+    for task in drain(results):
+        pending[task.index] = task
+        while next_index in pending:
+            task = pending.pop(next_index)
+            next_index += 1
+            errors.extend(task.errors)
+            for target in state.targets:
+                file = task.files[target.index]
+                if file.status is not None:
+                    print('%s[%i/%i][%sbit] %s... %s' % (target.label, task.index+1, len(tasks), task.bitDepth, task.item.title, file.status), flush=True)
+                bytes_written += file.bytesWritten
+                if file.needsSync and not file.failed:
+                    target.journal.done(file.outPath, target.manifest.get_entry(file.outPath), file.artChecked)
+    producer.join()
+
+    elapsed = max(time.time() - start_time, 0.001)
+    print('Synced %i unique tracks (referenced %i times by playlists)%s, %.1f MB written in %.1f seconds (%.2f MB/s, %.1f tracks/s)' % (
+        len(tasks),
+        references if references is not None else len(tasks),
+        ' to %i targets' % len(state.targets) if len(state.targets) > 1 else '',
+        bytes_written / 1000000,
+        elapsed,
+        bytes_written / 1000000 / elapsed,
+        len(tasks) / elapsed,
+    ))
     return errors
 
-# Process an audio file and update album art if necessary
-def parse_album_art_audiofile(filepath):
+# Save changed tags to a copy of filepath and rename that into place, so an interrupted sync never leaves a half
+# rewritten file behind. mutagen saves in place, which rewrites the whole file anyway once the tags outgrow the padding.
+# With outputPath, the copy is renamed to that instead and filepath is left alone.
+def save_tags_atomic(audio, filepath, outputPath = None):
+    outputPath = outputPath or filepath
+    part_path = outputPath + ".part"
+    shutil.copyfile(filepath, part_path)
+    try:
+        audio.save(part_path)
+        os.replace(part_path, outputPath)
+    except BaseException:
+        os.remove(part_path)
+        raise
+
+# Process an audio file and update album art if necessary, to a baseline jpeg of at most coverSize
+# Returns ALBUM_ART_CONVERTED if the file was saved with new album art, to outputPath instead if it is given,
+# another ALBUM_ART note if there was nothing to convert, or None if the album art was fine.
+# Nothing is printed here, it runs on the pipeline workers, see add_album_art_note
+def parse_album_art_audiofile(filepath, artCache: ArtCache = None, coverSize: int = MAX_SIZE, outputPath: str = None):
     ext = os.path.splitext(filepath)[1].lower()
     if ext == ".mp3":
         audio = MP3(filepath, ID3=ID3)
         if audio.tags and "APIC:" in audio.tags:
             apic = audio.tags["APIC:"]
-            new_art = convert_album_art_image_baseline_jpeg(apic.data, filepath)
+            new_art = convert_album_art_image_baseline_jpeg(apic.data, artCache, coverSize)
             if new_art != apic.data:
                 audio.tags["APIC:"] = APIC(
                     encoding=3, mime="image/jpeg", type=3, desc="Cover", data=new_art
                 )
-                audio.save()
+                save_tags_atomic(audio, filepath, outputPath)
+                return ALBUM_ART_CONVERTED
         else:
-            print(f"- {os.path.basename(filepath)}... No album art.")
+            return ALBUM_ART_MISSING
     elif ext == ".flac":
         audio = FLAC(filepath)
         if audio.pictures:
-            new_art = convert_album_art_image_baseline_jpeg(audio.pictures[0].data, filepath)
+            new_art = convert_album_art_image_baseline_jpeg(audio.pictures[0].data, artCache, coverSize)
             if new_art != audio.pictures[0].data:
                 audio.pictures[0].data = new_art
                 audio.pictures[0].mime = "image/jpeg"
-                audio.save()
+                save_tags_atomic(audio, filepath, outputPath)
+                return ALBUM_ART_CONVERTED
         else:
-            print(f"- {os.path.basename(filepath)}... No album art.")
+            return ALBUM_ART_MISSING
     elif ext == ".m4a":
         audio = MP4(filepath)
         if "covr" in audio.tags:
-            new_art = convert_album_art_image_baseline_jpeg(audio.tags["covr"][0], filepath)
+            new_art = convert_album_art_image_baseline_jpeg(audio.tags["covr"][0], artCache, coverSize)
             if new_art != audio.tags["covr"][0]:
                 audio.tags["covr"] = [MP4Cover(new_art, imageformat=MP4Cover.FORMAT_JPEG)]
-                audio.save()
+                save_tags_atomic(audio, filepath, outputPath)
+                return ALBUM_ART_CONVERTED
+        else:
+            return ALBUM_ART_MISSING
+    elif ext == ".opus":
+        audio = OggOpus(filepath)
+        if audio.tags and "metadata_block_picture" in audio.tags:
+            picture = Picture(base64.b64decode(audio.tags["metadata_block_picture"][0]))
+            new_art = convert_album_art_image_baseline_jpeg(picture.data, artCache, coverSize)
+            if new_art != picture.data:
+                picture.data = new_art
+                picture.mime = "image/jpeg"
+                audio.tags["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
+                save_tags_atomic(audio, filepath, outputPath)
+                return ALBUM_ART_CONVERTED
         else:
-            print(f"- {os.path.basename(filepath)}... No album art.")
+            return ALBUM_ART_MISSING
     elif ext == ".wav":
-        print(f"- {os.path.basename(filepath)}... Skipping WAV file (no standard embedded artwork support)")
+        return ALBUM_ART_WAV
 
-# Process all album art of audio files in a directory tree, making them baseline jpegs
-def parse_album_art(root_folder):
-    files_to_process = []
-    errors = []
+    return None
 
-    for root, _, files in os.walk(root_folder):
-        for file in files:
-            if os.path.splitext(file)[1].lower() in {".flac", ".m4a", ".mp3", ".wav"}:
-                filepath = os.path.join(root, file)
-                files_to_process.append(filepath)
+# Fetches the items of changed playlists from plex, and takes those of unchanged playlists from the manifest.
+# Yields (playlist, items, unchanged) for every playlist, items is None if the playlist could not be fetched.
+def fetch_playlists(plex: PlexServer, playlists: list, config: Config, outDir: str, manifest: SyncManifest, metrics: Metrics = None):
+    fingerprints = {playlist.ratingKey: get_playlist_fingerprint(playlist) for playlist in playlists}
+    stored_items = {
+        playlist.ratingKey: manifest.get_plex_playlist(playlist.ratingKey, fingerprints[playlist.ratingKey])
+        for playlist in playlists
+    }
+    unchanged_playlists = [playlist for playlist in playlists if stored_items[playlist.ratingKey] is not None]
+    changed_playlists = [playlist for playlist in playlists if stored_items[playlist.ratingKey] is None]
+    print('%i playlists changed since the last sync' % len(changed_playlists))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-        futures = {executor.submit(parse_album_art_audiofile, filepath): filepath for filepath in files_to_process}
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                log = f"Could not process album art of {futures[future]}: {e}"
-                print(log)
-                errors.append(log)
-    
+    # Changed playlists go first, so the tracks have the data of plex before the stored items of unchanged
+    # playlists are added, and before their output paths are worked out. See write_playlists for stored items
+    # that differ from that.
+    tracks = create_track_table(config.plex_music_root, config.fs_music_root, outDir)
+    stored_playlist_items = (
+        TrackList(tracks, [tracks.add(*item_state) for item_state in stored_items[playlist.ratingKey]])
+        for playlist in unchanged_playlists
+    )
+    fetched_playlist_items = get_playlist_items(
+        plex,
+        changed_playlists,
+        tracks,
+        config.jobs or DEFAULT_CONFIG.jobs,
+        metrics,
+    )
+
+    for playlist, playlist_items in itertools.chain(
+        zip(changed_playlists, fetched_playlist_items),
+        zip(unchanged_playlists, stored_playlist_items),
+    ):
+        unchanged = stored_items[playlist.ratingKey] is not None
+        if not unchanged and playlist_items is not None:
+            manifest.set_plex_playlist(
+                playlist.ratingKey,
+                fingerprints[playlist.ratingKey],
+                [get_playlist_item_state(item) for item in playlist_items],
+            )
+        if playlist_items is None:
+            print('Converting %s... Failed to get playlist' % playlist.title)
+        yield playlist, playlist_items, unchanged
+
+# Writes the playlist files of the fetched playlists in every format turned on in the config,
+# and removes the files of playlists that are gone. See playlists.render_playlists
+# extensions are the extensions of the tracks that are converted to another format for profile, by row, see
+# get_output_extensions. All playlists are rendered again when the profile changed.
+# Unchanged playlists with tracks that a changed playlist brought other plex data for, like a new title, are rendered
+# again too, and their items in the manifest are updated.
+def write_playlists(fetchedPlaylists: list, config: Config, outDir: str, manifest: SyncManifest, profile: TranscodeProfile = None, extensions: dict = None):
+    formats = [key for key in PLAYLIST_FORMATS if config.get(key)]
+    profile = profile or TranscodeProfile.from_config(config)
+    profile_changed = manifest.profile != profile.name
+    manifest.profile = profile.name
+    to_render = []
+    for playlist, playlist_items, unchanged in fetchedPlaylists:
+        if playlist_items is None:
+            continue
+        if not playlist_items:
+            print('Converting %s... Playlist is empty' % playlist.title)
+            continue
+        updated = playlist_items.tracks.updated
+        if unchanged and updated and any(row in updated for row in playlist_items.rows):
+            unchanged = False
+            manifest.update_plex_playlist_items(playlist.ratingKey, [get_playlist_item_state(item) for item in playlist_items])
+        to_render.append((playlist.title, playlist_items, unchanged and not profile_changed))
+
+    for playlist_name in render_playlists(to_render, formats, outDir, manifest, extensions):
+        print('Converting %s... Done' % playlist_name, flush=True)
+
+    manifest.remove_stale_playlists(get_playlist_folders(outDir))
+
+# The extensions of the tracks that have another extension on target than in the library, by row of the track table
+def get_output_extensions(tasks: list[SyncTask], target: SyncTarget):
+    extensions = {}
+    for task in tasks:
+        extension = os.path.splitext(task.files[target.index].outPath)[1]
+        if extension != os.path.splitext(task.item.fsPath)[1]:
+            extensions[task.item.row] = extension
+    return extensions
+
+# Creates a target for an out dir, with a copy engine that follows its fsync setting
+def create_sync_target(outDir: str, config: Config, cache: ProbeCache = None):
+    return SyncTarget(
+        outDir,
+        config,
+        CopyEngine(
+            (config.copy_buffer_mb or DEFAULT_CONFIG.copy_buffer_mb) * 1024 * 1024,
+            config.fsync or DEFAULT_CONFIG.fsync,
+            config.staging_dir,
+        ),
+        cache=cache,
+    )
+
+# Everything a sync does once plex is connected: load the caches and manifests, fetch and probe the tracks of all
+# playlists, plan what that means for the Music folder of every target, and only then delete orphans, write the
+# playlists and sync the files. plex can be anything with playlists() and query(), like plex_stub.StubPlex.
+# targets is a list of (out dir, config). Plex, the source and the converting are set up with the config of the
+# first one, and every source file is read and converted once for all of them. Playlist formats, album art checks
+# and fsync come from the config of each target. The probes of the source files are cached in the first out dir, the
+# album art verdicts of every target in its own, as they are about the files on that device.
+# With dryRun, the plans are printed and nothing on the out dirs is changed. Nothing is written to a target either if
+# its plan does not fit on the device. If the previous run to a target was interrupted, its journal is replayed first.
+# Returns the errors of the sync. If timings is given, the seconds spent in every phase are added to it.
+# A report with the phases, the latencies of the expensive calls and the cache hits is written next to the configs.
+def run_sync(plex, targets: list, source = None, pruneCache: bool = False, timings: dict = None, dryRun: bool = False):
+    source = source or LocalFileSystem()
+    timings = timings if timings is not None else {}
+    metrics = Metrics()
+    started = time.time()
+    config = targets[0][1]
+    with timed_phase(timings, "load"):
+        cache = load_probe_cache(targets[0][0])
+        # The first out dir has the source probes and its own album art verdicts in the same cache
+        sync_targets = [
+            create_sync_target(outDir, targetConfig, cache if index == 0 else None)
+            for index, (outDir, targetConfig) in enumerate(targets)
+        ]
+        if pruneCache:
+            pruned = cache.prune(source) + sum(target.cache.prune() for target in sync_targets[1:])
+            print('Pruned %i entries from the probe cache' % pruned)
+
+        for index, target in enumerate(sync_targets):
+            target.index = index
+            if target.journal.exists():
+                done, incomplete = target.journal.replay(target.manifest, target.cache)
+                print('Resuming an interrupted sync to %s: %i files were done, %i were cut off and are synced again' % (
+                    target.outDir, done, incomplete,
+                ))
+                if not dryRun:
+                    target.manifest.save()
+                    target.cache.save()
+                    target.journal.finish()
+        primary = sync_targets[0]
+
+    print('')
+    with timed_phase(timings, "list playlists"):
+        playlists = get_playlists(plex, config.ignore_playlists or DEFAULT_CONFIG.ignore_playlists)
+
+    art_jobs = config.art_jobs or DEFAULT_CONFIG.art_jobs
+    fast_probe = config.fast_probe is not False
+    transcode_cache_max_gb = config.transcode_cache_max_gb if config.transcode_cache_max_gb is not None else DEFAULT_CONFIG.transcode_cache_max_gb
+    transcode_cache = None
+    if transcode_cache_max_gb > 0:
+        transcode_cache = TranscodeCache(
+            config.transcode_cache_dir or os.path.join(get_default_cache_dir(), "transcodes"),
+            transcode_cache_max_gb * 1000000000,
+        )
+    art_cache = ArtCache(cache_dir=config.album_art_cache_dir)
+    state = SyncState(
+        cache,
+        sync_targets,
+        config.warn_lossy_format,
+        fast_probe,
+        Transcoder(
+            config.transcode_jobs or DEFAULT_CONFIG.transcode_jobs,
+            config.staging_dir,
+            config.transcode_backend or DEFAULT_CONFIG.transcode_backend,
+            fast_probe,
+            transcode_cache,
+            art_cache,
+        ),
+        art_cache,
+        create_album_art_process_pool(art_jobs, config.album_art_cache_dir) if config.art_processes else None,
+        CopyEngine(
+            (config.copy_buffer_mb or DEFAULT_CONFIG.copy_buffer_mb) * 1024 * 1024,
+            FSYNC_NONE,
+            config.staging_dir,
+        ),
+        config.read_ahead if config.read_ahead is not None else DEFAULT_CONFIG.read_ahead,
+        source,
+        metrics=metrics,
+    )
+
+    def close_state():
+        state.copyEngine.close()
+        for target in sync_targets:
+            target.copyEngine.close()
+        state.transcoder.close()
+        if state.artProcesses is not None:
+            state.artProcesses.shutdown()
+
+    fetched_playlists = []
+    def playlists_items():
+        for playlist, playlist_items, unchanged in fetch_playlists(plex, playlists, config, primary.outDir, primary.manifest, metrics):
+            fetched_playlists.append((playlist, playlist_items, unchanged))
+            if playlist_items is not None:
+                yield playlist_items
+
+    print('Fetching and probing playlist tracks')
+    with timed_phase(timings, "scan"):
+        existing_files = [target.listings.scan(target.musicDir) for target in sync_targets]
+    with timed_phase(timings, "fetch and probe"):
+        tasks, references = probe_files(playlists_items(), state, config.jobs or DEFAULT_CONFIG.jobs)
+    with timed_phase(timings, "plan"):
+        # Tracks of a playlist that could not be fetched would look like orphans
+        all_fetched = all(playlist_items is not None for _, playlist_items, _ in fetched_playlists)
+        plans = [plan_sync(tasks, target, existing_files[target.index], all_fetched) for target in sync_targets]
+    if not all_fetched:
+        print('Not all playlists could be fetched, orphans are not deleted this time')
+
+    space_errors = []
+    for target in sync_targets:
+        if len(sync_targets) > 1:
+            print('Plan for %s:' % target.outDir)
+        print(plans[target.index].summary(dryRun))
+        if not plans[target.index].fits():
+            space_errors.append('Not enough free space on %s, nothing was changed there' % target.outDir)
+    if dryRun or len(space_errors) == len(sync_targets):
+        close_state()
+        if dryRun:
+            print('Dry run, nothing was changed')
+        return [error for task in tasks for error in task.errors] + ([] if dryRun else space_errors)
+    state.set_targets([target for target in sync_targets if plans[target.index].fits()])
+
+    # From here on the out dirs are changed. The probes are kept and every written file is journaled,
+    # so a run that is interrupted continues where it stopped, see SyncJournal
+    cache.save()
+    for target in state.targets:
+        plan = plans[target.index]
+        target.journal.open()
+        target.journal.planned(path for action in [ACTION_COPY, ACTION_CONVERT] for path, _ in plan.files[action])
+
+    with timed_phase(timings, "prune"):
+        for target in state.targets:
+            plans[target.index].remove_orphans(target.manifest)
+    with timed_phase(timings, "playlists"):
+        for target in state.targets:
+            if target is primary:
+                target_playlists = fetched_playlists
+            else:
+                target_playlists = [
+                    (playlist, playlist_items, playlist_items is not None and target.manifest.take_plex_playlist(playlist.ratingKey, primary.manifest))
+                    for playlist, playlist_items, _ in fetched_playlists
+                ]
+            write_playlists(target_playlists, target.config, target.outDir, target.manifest, target.profile, get_output_extensions(tasks, target))
+
+    print('Syncing files')
+    for target in state.targets:
+        os.makedirs(target.musicDir, exist_ok=True)
+    with timed_phase(timings, "sync"):
+        errors = sync_files(
+            tasks,
+            state,
+            config.jobs or DEFAULT_CONFIG.jobs,
+            art_jobs,
+            references,
+        ) + space_errors
+
+    with timed_phase(timings, "save"):
+        close_state()
+        for target in state.targets:
+            target.manifest.save()
+            target.cache.save()
+            target.journal.finish()
+        cache.save()
+
+    report = {
+        "started": started,
+        "phases": timings,
+        **metrics.report(),
+        "caches": {
+            "probe": {"hits": cache.probe_hits, "misses": cache.probe_misses},
+            "album art": {
+                "hits": sum(target.cache.art_hits for target in sync_targets),
+                "misses": sum(target.cache.art_misses for target in sync_targets),
+            },
+            "transcode": {"hits": transcode_cache.hits, "misses": transcode_cache.misses} if transcode_cache is not None else None,
+        },
+        "read ahead": {
+            "read bytes": state.copyEngine.readBytes,
+            "read seconds": state.copyEngine.readSeconds,
+        },
+        "copy engines": {
+            target.outDir: {
+                "read bytes": target.copyEngine.readBytes,
+                "read seconds": target.copyEngine.readSeconds,
+                "write bytes": target.copyEngine.writeBytes,
+                "write seconds": target.copyEngine.writeSeconds,
+                "transcode profile": target.profile.name,
+            }
+            for target in state.targets
+        },
+        "errors": len(errors),
+    }
+    for target in state.targets:
+        write_report(os.path.join(target.outDir, f"run_report_{get_machine_name()}.json"), report)
+
+    print('')
+    print(metrics.summary())
+    print(cache.summary())
+    for target in sync_targets[1:]:
+        print('%s%s' % (target.label, target.cache.art_summary()))
+    if state.readAhead > 0:
+        print('Read ahead: %s' % state.copyEngine.summary())
+    for target in state.targets:
+        print('%s%s' % (target.label, target.copyEngine.summary()))
+    if transcode_cache is not None:
+        print(transcode_cache.summary())
     return errors
 
 def main():
     start_time = time.time()
 
     args = parse_args()
-    config, config_path = load_config(args.out_dir)
-    update_config(config_path, config, args)
+    targets = []
+    for out_dir in args.out_dir:
+        target_config, config_path = load_config(out_dir)
+        update_config(config_path, target_config, args)
+        targets.append((out_dir, target_config))
+    config = targets[0][1]  # plex and the music library are taken from the first out dir
 
     print('Checking folder paths...')
-    ensure_access_to_folder(args.out_dir)
+    for out_dir in args.out_dir:
+        ensure_access_to_folder(out_dir)
     ensure_access_to_folder(config.fs_music_root)
+    try:
+        source = get_file_system(config.fs_music_root, config.smb_username, config.smb_password)
+        if is_smb_url(config.fs_music_root) and source.stat(config.fs_music_root) is None:
+            raise FileNotFoundError(config.fs_music_root)
+    except Exception as err:
+        print('Could not access %s' % config.fs_music_root)
+        print(err)
+        return
 
     print('Connecting to Plex...', end='')
     try:
-        plex = PlexServer(config.host, config.token)
+        plex = connect_plex(config.host, config.token, config.jobs or DEFAULT_CONFIG.jobs)
     except (plexapi.exceptions.Unauthorized, requests.exceptions.ConnectionError) as err:
         print(' failed. Check your token and/or host')
         print(err)
         return
     print(' Success')
 
-    music_dir = os.path.join(args.out_dir, MUSIC_FOLDER_OUT_DIR)
-    if not os.path.exists(music_dir):
-        os.makedirs(music_dir)
-    
-    simpleAbsDir = os.path.join(args.out_dir, "Playlists_SimpleAbstract")
-    if os.path.exists(simpleAbsDir):
-        shutil.rmtree(simpleAbsDir)
-
-    playlistDir = os.path.join(args.out_dir, "Playlists")
-    if os.path.exists(playlistDir):
-        shutil.rmtree(playlistDir)
-
-    print('')
-    playlist_titles = get_playlists(plex, config.ignore_playlists or DEFAULT_CONFIG.ignore_playlists)
-    all_songs = []
-    for playlist_name in playlist_titles:
-        print('Converting %s...' % playlist_name, end='', flush=True)
-
-        playlist_items = get_playlist_items(
-            plex,
-            playlist_name,
-            config.plex_music_root,
-            config.fs_music_root,
-            args.out_dir,
+    if args.profile:
+        errors = run_profiled(
+            args.profile,
+            os.path.join(args.out_dir[0], f"profile_{get_machine_name()}"),
+            lambda: run_sync(plex, targets, source, args.prune_cache, dryRun=args.dry_run),
         )
-        if playlist_items is None:
-            print(' Failed to get playlist')
-            continue
-        if not playlist_items:
-            print(' Playlist is empty')
-            continue
-        print('.', end='', flush=True)
-        
-        if config.sync_simple_abstract: 
-            create_m3u_simple_abstract(
-                playlist_name,
-                playlist_items,
-                simpleAbsDir,
-            )
-            print('.', end='', flush=True)
-
-        if config.sync_extended_relative:
-            create_m3u8_extended_relative(
-                playlist_name,
-                playlist_items,
-                playlistDir,
-            )
-            print('.', end='', flush=True)
-
-        print(' Done')
-
-        for item in playlist_items:
-            all_songs.append(item)
+    else:
+        errors = run_sync(plex, targets, source, args.prune_cache, dryRun=args.dry_run)
 
-    print('')
-    print('Syncing files')
-    errors = []
-    errors.extend(copy_files(all_songs, config.warn_lossy_format))
-    
-    if not config.skip_album_art_checks:
-        print('')
-        print("Checking album art")
-        errors.extend(parse_album_art(music_dir));
-    
-    print('')
     print("Job's done")
     print('Elapsed time: %i minutes and %i seconds' % divmod(time.time() - start_time, 60))
     if len(errors) > 0:
@@ -301,4 +1083,5 @@ def main():
             print(error)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()    # album art processes in the pyinstaller binary
     main()
@@ -0,0 +1,341 @@
+"""Benchmarks for PlexPlaylistSync on a generated library, so no Plex server, SMB share or flash drive is needed.
+Needs ffmpeg, like PlexPlaylistSync itself.
+
+    python benchmark.py album-art --albums 30 --tracks 10 --jobs 8
+    python benchmark.py image-header
+    python benchmark.py sync --albums 50 --tracks 10 --playlists 10 --playlist-size 100 --overlap 0.5
+    python benchmark.py memory --tracks 100000 --playlists 500 --playlist-size 200
+"""
+import io
+import os
+import sys
+import time
+import random
+import contextlib
+import shutil
+import argparse
+import tracemalloc
+import tempfile
+import subprocess
+import concurrent.futures
+from PIL import Image
+from mutagen.flac import FLAC, Picture
+from mutagen.mp3 import MP3
+from mutagen.id3 import ID3, APIC
+from mutagen.mp4 import MP4, MP4Cover
+import PlexPlaylistSync
+import utils
+from cache import ArtCache
+from plex_stub import StubPlex, StubPlaylist, StubTrack
+from tracks import TrackList
+
+FORMATS = [".flac", ".mp3", ".m4a"]
+
+# (size, format, progressive), the last one is already fine and only needs checking
+COVERS = [
+    (1200, "JPEG", True),
+    (800, "PNG", False),
+    (500, "JPEG", False),
+]
+
+def generate_track(path, seconds = 2, bitDepth = 16):
+    codec_args = {
+        ".flac": ['-c:a', 'flac', '-sample_fmt', 's16' if bitDepth <= 16 else 's32'],
+        ".mp3": ['-c:a', 'libmp3lame', '-b:a', '192k'],
+        ".m4a": ['-c:a', 'aac', '-b:a', '192k'],
+    }[os.path.splitext(path)[1]]
+    if bitDepth > 16:
+        codec_args += ['-bits_per_raw_sample', str(bitDepth)]
+
+    subprocess.run(
+        ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', 'sine=frequency=440:duration=%i' % seconds, '-ac', '2']
+        + codec_args + [path],
+        check=True,
+    )
+
+def generate_cover(size, img_format, progressive):
+    noise = Image.effect_noise((size, size), 64)    # noise, so encoding costs about as much as a real cover
+    img = Image.merge("RGB", (noise, noise.rotate(90), noise.rotate(180)))
+    output = io.BytesIO()
+    img.save(output, format=img_format, **({"progressive": True} if progressive else {}))
+    return output.getvalue()
+
+def embed_cover(path, data, img_format):
+    mime = "image/%s" % img_format.lower()
+    ext = os.path.splitext(path)[1]
+    if ext == ".flac":
+        audio = FLAC(path)
+        picture = Picture()
+        picture.type = 3
+        picture.mime = mime
+        picture.data = data
+        audio.add_picture(picture)
+    elif ext == ".mp3":
+        audio = MP3(path, ID3=ID3)
+        if audio.tags is None:
+            audio.add_tags()
+        audio.tags.add(APIC(encoding=3, mime=mime, type=3, desc="", data=data))
+    else:
+        audio = MP4(path)
+        image_format = MP4Cover.FORMAT_PNG if img_format == "PNG" else MP4Cover.FORMAT_JPEG
+        audio["covr"] = [MP4Cover(data, imageformat=image_format)]
+    audio.save()
+
+# Generates albums * tracks files, rotating through the formats and cover kinds per album.
+# Every track of an album has the same cover, like in a real library. Returns the paths relative to root.
+# hiresShare of the FLAC albums is 24 bit, so those are converted when synced.
+def generate_library(root, albums, tracks, seconds = 2, hiresShare = 0.0):
+    os.makedirs(root, exist_ok=True)
+    templates = {}
+    for ext in FORMATS:
+        templates[ext] = os.path.join(root, "template" + ext)
+        generate_track(templates[ext], seconds)
+    templates["hires"] = os.path.join(root, "template-hires.flac")
+    generate_track(templates["hires"], seconds, 24)
+
+    files = []
+    flac_albums = 0
+    for album in range(albums):
+        ext = FORMATS[album % len(FORMATS)]
+        template = templates[ext]
+        if ext == ".flac":
+            if int((flac_albums + 1) * hiresShare) > int(flac_albums * hiresShare):   # spread evenly
+                template = templates["hires"]
+            flac_albums += 1
+        size, img_format, progressive = COVERS[album % len(COVERS)]
+        cover = generate_cover(size, img_format, progressive)
+        album_dir = os.path.join(root, "Artist %i" % (album % 10), "Album %i" % album)
+        os.makedirs(album_dir, exist_ok=True)
+        for track in range(tracks):
+            path = os.path.join(album_dir, "%02i Track%s" % (track + 1, ext))
+            shutil.copy(template, path)
+            embed_cover(path, cover, img_format)
+            files.append(os.path.relpath(path, root))
+
+    for template in templates.values():
+        os.remove(template)
+    return files
+
+def timed(name, count, func):
+    start_time = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start_time
+    print('%-24s %8.3f s  %10.1f files/s' % (name, elapsed, count / elapsed))
+    return elapsed
+
+def bench_album_art(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source")
+        print('Generating %i albums of %i tracks...' % (args.albums, args.tracks))
+        files = generate_library(source, args.albums, args.tracks)
+
+        def run_threads(root):
+            art_cache = ArtCache()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                list(executor.map(lambda path: PlexPlaylistSync.parse_album_art_audiofile(os.path.join(root, path), art_cache), files))
+
+        def run_processes(root):
+            with executor:
+                list(executor.map(PlexPlaylistSync.parse_album_art_audiofile_in_process, [os.path.join(root, path) for path in files]))
+
+        for name, run in [("threads", run_threads), ("processes", run_processes)]:
+            if run is run_processes:
+                # The pool starts its processes on the first task, so creating it here does not skew the timing
+                executor = PlexPlaylistSync.create_album_art_process_pool(args.jobs)
+                if executor is None:
+                    print('%-24s processes are not available, skipped' % ("album art, %s" % name))
+                    continue
+            root = os.path.join(tmp, name)
+            shutil.copytree(source, root)
+            timed("album art, %s" % name, len(files), lambda: run(root))
+
+# Cost per cover of the check whether it needs converting, with PIL (as before) and with the header parser
+def bench_image_header(args):
+    def check_with_pil(data):
+        with Image.open(io.BytesIO(data)) as img:
+            return utils.get_opened_image_dimensions_format_and_progressive(img)
+
+    for size, img_format, progressive in COVERS:
+        data = generate_cover(size, img_format, progressive)
+        name = "%ipx %s%s" % (size, "progressive " if progressive else "", img_format)
+        for method, func in [("PIL", check_with_pil), ("header", utils.parse_image_header)]:
+            start_time = time.perf_counter()
+            for _ in range(args.iterations):
+                func(data)
+            elapsed = time.perf_counter() - start_time
+            print('%-28s %-8s %8.2f us per cover' % (name, method, elapsed / args.iterations * 1000000))
+
+PLEX_MUSIC_ROOT = "/plex/music"
+
+# Playlists of playlistSize tracks each. overlap is the share of every playlist that comes from the same
+# set of favorite tracks, the rest is picked from the whole library.
+def generate_playlists(files, playlists, playlistSize, overlap, rng):
+    playlistSize = min(playlistSize, len(files))
+    tracks = [
+        StubTrack(str(index), os.path.splitext(os.path.basename(path))[0], 2000, "%s/%s" % (PLEX_MUSIC_ROOT, path))
+        for index, path in enumerate(files)
+    ]
+    favorites = rng.sample(tracks, playlistSize)
+    result = []
+    for playlist in range(playlists):
+        shared = int(playlistSize * overlap)
+        picked = favorites[:shared]
+        others = [track for track in tracks if track not in picked]
+        picked += rng.sample(others, playlistSize - shared)
+        rng.shuffle(picked)
+        result.append(StubPlaylist(playlist + 1, "Playlist %i" % (playlist + 1), picked))
+    return result
+
+# Changes share of the files, like a retag does: new contents and modification time
+def change_files(root, files, share, rng):
+    changed = rng.sample(files, max(int(len(files) * share), 1))
+    for path in changed:
+        full_path = os.path.join(root, path)
+        stat = os.stat(full_path)
+        with open(full_path, 'ab') as file:
+            file.write(b"\0" * 16)   # padding after the last frame, players ignore it
+        os.utime(full_path, (stat.st_atime + 120, stat.st_mtime + 120))
+    return changed
+
+# Runs full, no-op and changed syncs of a generated library to an empty out dir, and prints how long every phase took
+def bench_sync(args):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source")
+        out_dir = os.path.join(tmp, "out")
+        os.makedirs(out_dir)
+        print('Generating %i albums of %i tracks...' % (args.albums, args.tracks))
+        files = generate_library(source, args.albums, args.tracks, hiresShare=args.hires)
+        plex = StubPlex(generate_playlists(files, args.playlists, args.playlist_size, args.overlap, rng))
+        synced_files = sorted({
+            os.path.relpath(track.file, PLEX_MUSIC_ROOT) for playlist in plex.playlists() for track in playlist.tracks
+        })
+        config = utils.Config(dict(
+            utils.DEFAULT_CONFIG,
+            fs_music_root=source,
+            plex_music_root=PLEX_MUSIC_ROOT,
+            jobs=args.jobs,
+            fsync=args.fsync,
+            transcode_codec=args.codec,
+            transcode_cache_dir=os.path.join(tmp, "transcodes"),
+        ))
+
+        scenarios = [
+            ("full", lambda: None),
+            ("no-op", lambda: None),
+            ("%g%% changed" % (args.changed * 100), lambda: change_files(source, synced_files, args.changed, rng)),
+        ]
+        results = []
+        for name, prepare in scenarios:
+            prepare()
+            timings = {}
+            start_time = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                errors = PlexPlaylistSync.run_sync(plex, [(out_dir, config)], timings=timings)
+            timings["total"] = time.perf_counter() - start_time
+            results.append((name, timings, len(errors)))
+
+        phases = list(results[0][1].keys())
+        print('%-14s' % "" + "".join('%16s' % phase for phase in phases) + '%8s' % "errors")
+        for name, timings, errors in results:
+            print('%-14s' % name + "".join('%14.3f s' % timings.get(phase, 0) for phase in phases) + '%8i' % errors)
+
+# A playlist item the way they were stored before the track table: an object with every path, per playlist reference
+class PlainPlaylistItem:
+    def __init__(self, title, duration, plexPath, fsRoot, outRoot, ratingKey, updatedAt):
+        self.title = title.replace(':', '_').replace('/', '_').replace('?', '')
+        self.duration = duration / 1000
+        self.plexPath = plexPath
+        self.fsPath = plexPath.replace(PLEX_MUSIC_ROOT, fsRoot)
+        self.outPath = utils.rename_filename_keep_extension(plexPath.replace(PLEX_MUSIC_ROOT, outRoot), self.title)
+        self.playlistRelPath = utils.rename_filename_keep_extension(plexPath.replace(PLEX_MUSIC_ROOT, PlexPlaylistSync.REL_PATH_FOR_PLAYLIST), self.title)
+        self.playlistAbsPath = utils.rename_filename_keep_extension(plexPath.replace(PLEX_MUSIC_ROOT, PlexPlaylistSync.ABS_PATH_FOR_PLAYLIST), self.title)
+        self.ratingKey = ratingKey
+        self.updatedAt = updatedAt
+
+# Memory of the playlist items of a large library, as plain objects per reference and in the track table.
+# Only the items are built, the library is made up and never written.
+def bench_memory(args):
+    rng = random.Random(args.seed)
+    fs_root = "/run/user/1000/gvfs/smb-share:server=nas,share=media/Music"
+    out_dir = "/media/usb"
+    library = [
+        ("Track %i" % index, rng.randrange(120000, 480000),
+         "%s/Artist %i/Album %i/%02i Track %i.flac" % (PLEX_MUSIC_ROOT, index // 100, index // 10, index % 10 + 1, index),
+         str(index), str(1700000000 + index))
+        for index in range(args.tracks)
+    ]
+    playlists = [rng.sample(range(args.tracks), min(args.playlist_size, args.tracks)) for _ in range(args.playlists)]
+    references = sum(len(playlist) for playlist in playlists)
+    print('%i tracks, %i playlists, %i references' % (args.tracks, args.playlists, references))
+
+    def build_plain():
+        out_root = os.path.join(out_dir, PlexPlaylistSync.MUSIC_FOLDER_OUT_DIR)
+        return [[PlainPlaylistItem(*library[index][:3], fs_root, out_root, *library[index][3:]) for index in playlist] for playlist in playlists]
+
+    def build_table():
+        tracks = PlexPlaylistSync.create_track_table(PLEX_MUSIC_ROOT, fs_root, out_dir)
+        return [TrackList(tracks, [tracks.add(*library[index]) for index in playlist]) for playlist in playlists]
+
+    print('%-14s %10s %14s %10s %12s' % ("", "MB", "bytes/ref", "build s", "paths s"))
+    for name, build in [("plain objects", build_plain), ("track table", build_table)]:
+        tracemalloc.start()
+        items = build()
+        size = tracemalloc.get_traced_memory()[0]  # what is still alive, so the items
+        tracemalloc.stop()
+        del items
+
+        start_time = time.perf_counter()    # without tracemalloc, which slows down allocations a lot
+        items = build()
+        build_time = time.perf_counter() - start_time
+
+        # Every path once per reference, like a sync and the playlist formats read them
+        start_time = time.perf_counter()
+        for playlist_items in items:
+            for item in playlist_items:
+                item.fsPath, item.outPath, item.playlistRelPath
+        paths_time = time.perf_counter() - start_time
+        print('%-14s %10.1f %14.1f %10.2f %12.2f' % (name, size / 1000000, size / max(references, 1), build_time, paths_time))
+        del items
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    album_art = subparsers.add_parser("album-art", help="Compare checking album art with threads and with processes")
+    album_art.add_argument('--albums', type = int, default = 30)
+    album_art.add_argument('--tracks', type = int, default = 10)
+    album_art.add_argument('--jobs', type = int, default = os.cpu_count() or 1)
+    album_art.set_defaults(func=bench_album_art)
+
+    image_header = subparsers.add_parser("image-header", help="Compare checking cover headers with PIL and with the header parser")
+    image_header.add_argument('--iterations', type = int, default = 10000)
+    image_header.set_defaults(func=bench_image_header)
+
+    sync = subparsers.add_parser("sync", help="Time every phase of full, no-op and partly changed syncs, with a stub instead of Plex")
+    sync.add_argument('--albums', type = int, default = 30)
+    sync.add_argument('--tracks', type = int, default = 10)
+    sync.add_argument('--hires', type = float, default = 0.5, help="Share of the FLAC albums that is 24 bit")
+    sync.add_argument('--playlists', type = int, default = 5)
+    sync.add_argument('--playlist-size', type = int, default = 50)
+    sync.add_argument('--overlap', type = float, default = 0.5, help="Share of every playlist that is in all playlists")
+    sync.add_argument('--changed', type = float, default = 0.01, help="Share of the files changed before the last sync")
+    sync.add_argument('--jobs', type = int, default = utils.DEFAULT_CONFIG.jobs)
+    sync.add_argument('--fsync', type = str, default = utils.DEFAULT_CONFIG.fsync, choices = ["file", "album", "end", "none"])
+    sync.add_argument('--codec', type = str, default = utils.DEFAULT_CONFIG.transcode_codec, choices = ["keep", "flac", "opus", "aac"], help="Transcode codec of the out dir")
+    sync.add_argument('--seed', type = int, default = 1)
+    sync.add_argument('--verbose', action = 'store_true', help="Show the output of the syncs")
+    sync.set_defaults(func=bench_sync)
+
+    memory = subparsers.add_parser("memory", help="Compare the memory of the playlist items as plain objects and in the track table")
+    memory.add_argument('--tracks', type = int, default = 100000)
+    memory.add_argument('--playlists', type = int, default = 500)
+    memory.add_argument('--playlist-size', type = int, default = 200)
+    memory.add_argument('--seed', type = int, default = 1)
+    memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
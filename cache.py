@@ -0,0 +1,295 @@
+import os
+import json
+import hashlib
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from filesystem import is_smb_url
+from utils import MAX_SIZE, AudioProbe, get_machine_name, probe_audio
+
+class ProbeCache:
+    """Persistent cache of probe results and album art verdicts, keyed on path, size and mtime.
+    The album art verdict is the cover size the art was checked for.
+    The whole table is loaded on open and written back by save(), so workers never touch sqlite themselves.
+    The sqlite file is only created by the first save(), so a dry run leaves the out dir as it is."""
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.entries = {}   # path -> [size, mtime, probe dict or None, art_ok cover size or None]
+        self.dirty = set()
+        self.removed = set()
+        self.probe_hits = 0
+        self.probe_misses = 0
+        self.art_hits = 0
+        self.art_misses = 0
+
+        if not os.path.exists(cache_path):
+            return
+        with sqlite3.connect(cache_path) as db:
+            self._create_table(db)
+            for path, size, mtime, probe, art_ok in db.execute("SELECT path, size, mtime, probe, art_ok FROM entries"):
+                self.entries[path] = [
+                    size,
+                    mtime,
+                    json.loads(probe) if probe is not None else None,
+                    art_ok,
+                ]
+        db.close()
+
+    def _create_table(self, db):
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, probe TEXT, art_ok INTEGER)"
+        )
+
+    # Returns the entry for path if it still matches the stat result, otherwise None
+    def _get(self, path, stat):
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            return None
+        return entry
+
+    # Returns the entry for path, resetting it if the file changed. Call with the lock held.
+    def _get_or_reset(self, path, stat):
+        entry = self._get(path, stat)
+        if entry is None:
+            entry = [stat.st_size, stat.st_mtime, None, None]
+            self.entries[path] = entry
+        self.dirty.add(path)
+        self.removed.discard(path)
+        return entry
+
+    def get_probe(self, path, stat):
+        with self.lock:
+            entry = self._get(path, stat)
+            if entry is None or entry[2] is None:
+                self.probe_misses += 1
+                return None
+            self.probe_hits += 1
+            return AudioProbe(entry[2])
+
+    def set_probe(self, path, stat, probe):
+        with self.lock:
+            self._get_or_reset(path, stat)[2] = dict(probe) if probe is not None else {}
+
+    def get_art_ok(self, path, stat, coverSize = MAX_SIZE):
+        with self.lock:
+            entry = self._get(path, stat)
+            if entry is None or entry[3] != coverSize:
+                self.art_misses += 1
+                return None
+            self.art_hits += 1
+            return True
+
+    def set_art_ok(self, path, stat, coverSize = MAX_SIZE):
+        with self.lock:
+            self._get_or_reset(path, stat)[3] = coverSize
+
+    def probe(self, file_path, fast = True, stat = None, fileSystem = None):
+        """Probe a file, only running the probe if it is not cached for the current size and mtime.
+        Pass stat if it is already known, to save a stat call, and fileSystem if the OS cannot open file_path."""
+        stat = stat or (fileSystem.stat(file_path) if fileSystem is not None else os.stat(file_path))
+        probe = self.get_probe(file_path, stat)
+        if probe is None:
+            probe = probe_audio(file_path, fast, fileSystem) or AudioProbe()
+            self.set_probe(file_path, stat, probe)
+        return probe
+
+    def prune(self, fileSystem = None):
+        """Drop entries of files that no longer exist, returns the amount of dropped entries.
+        Only smb:// paths are looked up through fileSystem, the album art verdicts are of local files in the out dir."""
+        def exists(path):
+            if fileSystem is not None and is_smb_url(path):
+                return fileSystem.stat(path) is not None
+            return os.path.exists(path)
+
+        with self.lock:
+            missing = [path for path in self.entries if not exists(path)]
+            for path in missing:
+                del self.entries[path]
+                self.dirty.discard(path)
+                self.removed.add(path)
+        return len(missing)
+
+    def save(self):
+        with self.lock:
+            rows = [
+                (
+                    path,
+                    entry[0],
+                    entry[1],
+                    json.dumps(entry[2]) if entry[2] is not None else None,
+                    entry[3],
+                )
+                for path, entry in ((path, self.entries[path]) for path in self.dirty)
+            ]
+            removed = [(path,) for path in self.removed]
+            self.dirty.clear()
+            self.removed.clear()
+
+        if not rows and not removed:
+            return
+        with sqlite3.connect(self.cache_path) as db:
+            self._create_table(db)
+            db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+            db.executemany("DELETE FROM entries WHERE path = ?", removed)
+        db.close()
+
+    def art_summary(self):
+        return 'Album art cache: %i hits, %i misses.' % (self.art_hits, self.art_misses)
+
+    def summary(self):
+        return 'Probe cache: %i hits, %i misses. %s' % (self.probe_hits, self.probe_misses, self.art_summary())
+
+class ArtCache:
+    """Converted album art by hash of the original image bytes and the size, as every track of an album carries the same cover.
+    The most recently used covers are kept in memory, and if cache_dir is set all of them are also stored there.
+    An empty value means the original image did not need converting."""
+
+    def __init__(self, max_entries = 512, cache_dir = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_data, maxSize = MAX_SIZE):
+        key = hashlib.blake2b(image_data, digest_size=16).hexdigest()
+        return key if maxSize == MAX_SIZE else "%s-%i" % (key, maxSize)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".jpg")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        with open(self._path(key), 'rb') as file:
+            data = file.read()
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.cache_dir is not None:
+            tmp_path = "%s.%i.tmp" % (self._path(key), threading.get_ident())
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, self._path(key))
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class TranscodeCache:
+    """Converted files, shared by all devices that are synced from this machine.
+    Keyed on the source path, size and mtime and the conversion settings. Using a file marks it as recently used,
+    and the least recently used files are removed once the cache grows over max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failed_puts = 0
+        self.evicting = False   # only one thread walks the cache to evict files at a time
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._files())
+
+    def _files(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue    # still being written by put, or left behind by a crash
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def key(self, srcPath, srcStat, settings):
+        data = "%s\0%i\0%r\0%s" % (srcPath, srcStat.st_size, srcStat.st_mtime, settings)
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def has(self, key, ext):
+        """True if the file is cached, without counting it as a use."""
+        return os.path.exists(self._path(key, ext))
+
+    def get(self, key, ext):
+        """Returns the path of the cached file, or None."""
+        path = self._path(key, ext)
+        try:
+            os.utime(path)  # the mtime is the last use, for eviction
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, ext, file_path):
+        """Store a copy of file_path in the cache."""
+        path = self._path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%i.tmp" % (path, threading.get_ident())
+        try:
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            with self.lock:
+                self.failed_puts += 1
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.total_bytes += os.path.getsize(path)
+            over_limit = self.total_bytes > self.max_bytes and not self.evicting
+            self.evicting = self.evicting or over_limit
+        if over_limit:
+            try:
+                self.evict()
+            finally:
+                with self.lock:
+                    self.evicting = False
+
+    def evict(self):
+        """Remove the least recently used files until the cache is below 90% of max_bytes.
+        The cache is walked without holding the lock, so other threads can keep using it in the meantime."""
+        files = sorted(self._files(), key=lambda file: file[1])
+        total_bytes = sum(size for _, _, size in files)
+        for path, _, size in files:
+            if total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        with self.lock:
+            self.total_bytes = total_bytes
+
+    def summary(self):
+        failed = ', %i could not be stored' % self.failed_puts if self.failed_puts else ''
+        return 'Transcode cache: %i hits, %i misses%s, %.1f GB used.' % (self.hits, self.misses, failed, self.total_bytes / 1000000000)
+
+def get_default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "PlexPlaylistSync")
+
+def load_probe_cache(output_dir):
+    return ProbeCache(os.path.join(output_dir, f"probe_cache_{get_machine_name()}.sqlite"))
@@ -0,0 +1,191 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from filesystem import LocalFileSystem
+
+FSYNC_FILE = "file"     # after every file, safest but slowest on flash
+FSYNC_ALBUM = "album"   # the files of a folder together, once the sync moves on to another folder
+FSYNC_END = "end"       # once, at the end of the run
+FSYNC_NONE = "none"
+FSYNC_POLICIES = [FSYNC_FILE, FSYNC_ALBUM, FSYNC_END, FSYNC_NONE]
+
+def fsync_path(path):
+    with open(path, 'rb') as file:
+        os.fsync(file.fileno())
+
+class CopyEngine:
+    """Copies files with large sequential reads and writes, through a .part file that is renamed into place.
+
+    Files on the SMB share can be read ahead into a local staging dir with prefetch(), so reading the next files
+    from the share happens while the current one is written to the device. Copies between local files are done
+    by the kernel with copy_file_range or sendfile. Time spent reading and writing is counted separately."""
+
+    def __init__(self, bufferSize: int, fsyncPolicy: str = FSYNC_END, stagingDir: str = None, target = None):
+        self.local = LocalFileSystem()
+        self.target = target or self.local  # file system of the out dir
+        self.bufferSize = bufferSize
+        self.fsyncPolicy = fsyncPolicy
+        self.stagingParent = stagingDir
+        self.stagingDir = None  # created on the first prefetch()
+        self.lock = threading.Lock()
+        self.pendingFsync = {}  # folder -> files written since its last fsync
+        self.lastFolder = None
+        self.readBytes = 0
+        self.readSeconds = 0.0
+        self.writeBytes = 0
+        self.writeSeconds = 0.0
+
+    def _count(self, readBytes = 0, readSeconds = 0.0, writeBytes = 0, writeSeconds = 0.0):
+        with self.lock:
+            self.readBytes += readBytes
+            self.readSeconds += readSeconds
+            self.writeBytes += writeBytes
+            self.writeSeconds += writeSeconds
+
+    def _read_chunks(self, path, fileSystem):
+        """Yield the file in chunks of bufferSize, counting the time spent waiting for them as read time."""
+        chunks = fileSystem.read_chunks(path, self.bufferSize)
+        while True:
+            start_time = time.perf_counter()
+            chunk = next(chunks, b"")
+            self._count(readBytes=len(chunk), readSeconds=time.perf_counter() - start_time)
+            if not chunk:
+                return
+            yield chunk
+
+    def prefetch(self, src, fileSystem = None):
+        """Read src from fileSystem into the local staging dir. Returns the local path and the hash of the contents."""
+        with self.lock:
+            if self.stagingDir is None:
+                self.stagingDir = tempfile.mkdtemp(prefix="PlexPlaylistSync-read-", dir=self.stagingParent)
+        digest = hashlib.blake2b(digest_size=16)
+        fd, local_path = tempfile.mkstemp(dir=self.stagingDir, suffix=os.path.splitext(src)[1])
+        with os.fdopen(fd, 'wb') as fdst:
+            for chunk in self._read_chunks(src, fileSystem or self.local):
+                digest.update(chunk)
+                fdst.write(chunk)
+        return local_path, digest.hexdigest()
+
+    def release(self, local_path):
+        """Remove a file that was returned by prefetch()."""
+        if local_path is not None and os.path.exists(local_path):
+            os.remove(local_path)
+
+    def _kernel_copy(self, fsrc, fdst, size):
+        """Copy size bytes with copy_file_range, or sendfile if that is not supported. False if neither works here."""
+        for copy_func in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if copy_func is None:
+                continue
+            try:
+                copied = 0
+                while copied < size:
+                    if copy_func is os.sendfile:
+                        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, min(self.bufferSize, size - copied))
+                    else:
+                        sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(self.bufferSize, size - copied), copied, copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                if copied == size:
+                    return True
+            except OSError:
+                pass
+            fdst.seek(0)
+            fdst.truncate()
+        return False
+
+    def _copy_local(self, src, fdst):
+        start_time = time.perf_counter()
+        with open(src, 'rb', buffering=0) as fsrc:
+            size = os.fstat(fsrc.fileno()).st_size
+            if not self._kernel_copy(fsrc, fdst, size):
+                return False
+        self._count(writeBytes=size, writeSeconds=time.perf_counter() - start_time)
+        return True
+
+    def copy(self, src, dst, srcStat, srcHash = None, fileSystem = None):
+        """Copy src from fileSystem (the OS by default) to dst and give it the timestamps of srcStat, like shutil.copy2.
+        src can be a prefetched local copy, in which case srcHash is its hash. Returns the hash of the copied bytes."""
+        fileSystem = fileSystem or self.local
+        local_target = self.target.is_local(dst)
+        self.target.makedirs(os.path.dirname(dst))
+        part_path = dst + ".part"
+        digest = hashlib.blake2b(digest_size=16)
+
+        with self.target.open(part_path, 'wb') as fdst:
+            kernel_copied = local_target and fileSystem.is_local(src) and not fileSystem.is_remote(src) \
+                and self._copy_local(src, fdst)
+            if not kernel_copied:
+                for chunk in self._read_chunks(src, fileSystem):
+                    if srcHash is None:
+                        digest.update(chunk)
+                    start_time = time.perf_counter()
+                    fdst.write(chunk)
+                    self._count(writeBytes=len(chunk), writeSeconds=time.perf_counter() - start_time)
+            if self.fsyncPolicy == FSYNC_FILE and local_target:
+                start_time = time.perf_counter()
+                os.fsync(fdst.fileno())
+                self._count(writeSeconds=time.perf_counter() - start_time)
+
+        if local_target:
+            os.utime(part_path, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+        self.target.rename(part_path, dst)
+        if local_target:
+            self._written(dst)
+
+        if srcHash is not None:
+            return srcHash
+        if kernel_copied:
+            return hash_local_file(src)   # the bytes never passed through here, but the source is in the page cache now
+        return digest.hexdigest()
+
+    def _written(self, path):
+        if self.fsyncPolicy != FSYNC_ALBUM:
+            return
+
+        folder = os.path.dirname(path)
+        with self.lock:
+            self.pendingFsync.setdefault(folder, []).append(path)
+            done = []
+            if self.lastFolder is not None and self.lastFolder != folder:
+                done = [self.lastFolder]
+            self.lastFolder = folder
+            to_sync = [file for done_folder in done for file in self.pendingFsync.pop(done_folder, [])]
+        self._fsync(to_sync)
+
+    def _fsync(self, paths):
+        start_time = time.perf_counter()
+        for path in paths:
+            if os.path.exists(path):
+                fsync_path(path)
+        self._count(writeSeconds=time.perf_counter() - start_time)
+
+    def close(self):
+        """Flush whatever the fsync policy left pending, and remove the staging dir."""
+        start_time = time.perf_counter()
+        if self.fsyncPolicy == FSYNC_ALBUM:
+            self._fsync([path for paths in self.pendingFsync.values() for path in paths])
+            self.pendingFsync.clear()
+        elif self.fsyncPolicy == FSYNC_END:
+            os.sync()
+        self._count(writeSeconds=time.perf_counter() - start_time)
+        if self.stagingDir is not None:
+            shutil.rmtree(self.stagingDir, ignore_errors=True)
+
+    def summary(self):
+        def rate(size, seconds):
+            return size / 1000000 / seconds if seconds > 0 else 0
+        return 'Read %.1f MB in %.1f s (%.2f MB/s per worker), wrote %.1f MB in %.1f s (%.2f MB/s per worker).' % (
+            self.readBytes / 1000000, self.readSeconds, rate(self.readBytes, self.readSeconds),
+            self.writeBytes / 1000000, self.writeSeconds, rate(self.writeBytes, self.writeSeconds),
+        )
+
+def hash_local_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,148 @@
+import os
+import collections
+import threading
+from utils import is_gvfs_smb_share
+
+# Optional, to read the music library straight from the SMB server instead of through the GVfs mount
+try:
+    import smbclient
+except ImportError:
+    smbclient = None
+
+SMB_URL_PREFIX = "smb://"
+SMB_READ_AHEAD_BYTES = 8 * 1024 * 1024  # bytes requested from the server before waiting for the first answer
+
+def is_smb_url(path):
+    return path is not None and path.startswith(SMB_URL_PREFIX)
+
+# A file system has: stat, scandir, open, read_chunks, is_local and is_remote, and rename and makedirs if the out dir is on it.
+# The sync reads the music library and writes the out dir only through these, so both can be swapped out.
+# The out dir is always a LocalFileSystem for now, so the SMB client only reads.
+
+class LocalFileSystem:
+    """Files as the OS sees them, on local disks and on mounted shares like GVfs."""
+
+    def stat(self, path):
+        """Returns the stat result of path, or None if it does not exist."""
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def scandir(self, directory, subdirs: list = None):
+        """Returns a dict of file name -> stat result of the files in directory, with a single listing.
+        The names of the folders in it are appended to subdirs, if given."""
+        listing = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        listing[entry.name] = entry.stat()
+                    elif subdirs is not None and entry.is_dir():
+                        subdirs.append(entry.name)
+        except FileNotFoundError:
+            pass
+        return listing
+
+    def open(self, path, mode = 'rb'):
+        """Open path unbuffered, in binary mode. Callers read and write in large chunks themselves."""
+        return open(path, mode, buffering=0)
+
+    def read_chunks(self, path, bufferSize):
+        """Yield the contents of path in chunks of bufferSize."""
+        with self.open(path) as file:
+            while chunk := file.read(bufferSize):
+                yield chunk
+
+    def rename(self, src, dst):
+        """Rename src to dst, replacing dst if it exists. Atomic on the same file system."""
+        os.replace(src, dst)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def is_local(self, path):
+        """True if other programs, like ffmpeg, can open path."""
+        return True
+
+    def is_remote(self, path):
+        """True if reading path goes over the network, so it is worth reading it ahead and the kernel copy functions do not help."""
+        return is_gvfs_smb_share(path)[0]
+
+class SmbFileSystem:
+    """Reads smb://server/share/path urls with smbprotocol, without going through a FUSE mount.
+    Connections are pooled per server by smbclient and shared by all threads.
+    Listings come with the file sizes and times, so stat() of a listed file is no extra round trip,
+    and files are read with several requests in flight to hide the network latency."""
+
+    def __init__(self, username: str = None, password: str = None):
+        if smbclient is None:
+            raise RuntimeError("smb:// paths need the smbprotocol package: pip install smbprotocol")
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.sessions = set()
+
+    def _unc(self, path):
+        """smb://server/share/dir -> \\\\server\\share\\dir, registering a session for the server on first use.
+        Not parsed as a url, file names can have # and ? in them."""
+        server, _, share_path = path[len(SMB_URL_PREFIX):].partition("/")
+        with self.lock:
+            if server not in self.sessions:
+                smbclient.register_session(server, username=self.username, password=self.password)
+                self.sessions.add(server)
+        return "\\\\%s\\%s" % (server, share_path.replace("/", "\\"))
+
+    def stat(self, path):
+        try:
+            return smbclient.stat(self._unc(path))
+        except FileNotFoundError:
+            return None
+
+    def scandir(self, directory, subdirs: list = None):
+        listing = {}
+        try:
+            for entry in smbclient.scandir(self._unc(directory)):
+                if entry.is_file():
+                    listing[entry.name] = entry.stat()
+                elif subdirs is not None and entry.is_dir():
+                    subdirs.append(entry.name)
+        except FileNotFoundError:
+            pass
+        return listing
+
+    def open(self, path, mode = 'rb'):
+        return smbclient.open_file(self._unc(path), mode=mode)
+
+    def read_chunks(self, path, bufferSize):
+        """Yield the file in chunks, keeping up to SMB_READ_AHEAD_BYTES of read requests in flight."""
+        with smbclient.open_file(self._unc(path), mode='rb', buffering=0) as file:
+            smb_open = file.fd
+            connection = smb_open.connection
+            tree = smb_open.tree_connect
+            size = smb_open.end_of_file
+            chunk_size = max(min(bufferSize, connection.max_read_size), 1)
+            depth = max(SMB_READ_AHEAD_BYTES // chunk_size, 1)
+
+            pending = collections.deque()
+            for offset in range(0, size, chunk_size):
+                read, receive = smb_open.read(offset, min(chunk_size, size - offset), send=False)
+                pending.append((connection.send(read, tree.session.session_id, tree.tree_connect_id), receive))
+                if len(pending) >= depth:
+                    request, receive = pending.popleft()
+                    yield receive(request)
+            while pending:
+                request, receive = pending.popleft()
+                yield receive(request)
+
+    def is_local(self, path):
+        return False
+
+    def is_remote(self, path):
+        return True
+
+def get_file_system(root: str, smbUsername: str = None, smbPassword: str = None):
+    """The file system to access root with: the SMB client for smb:// urls, the OS for everything else."""
+    if is_smb_url(root):
+        return SmbFileSystem(smbUsername, smbPassword)
+    return LocalFileSystem()
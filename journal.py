@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import threading
+
+JOURNAL_FILENAME = "sync_journal.jsonl"
+JOURNAL_FSYNC_SECONDS = 1.0    # at most this much of the journal is lost when the device is pulled
+
+JOURNAL_PLANNED = "planned"
+JOURNAL_STARTED = "started"
+JOURNAL_DONE = "done"
+
+class SyncJournal:
+    """Write-ahead journal of a sync, one json line per output file and state, next to the manifest in the out dir.
+    Files are planned, then started before they are written and done once they are written and their album art
+    is checked. The manifest is only saved at the end of a run, so the journal is what a run that was interrupted
+    halfway leaves behind: replay() brings the manifest up to date with the files that were done, and makes sure
+    the ones that were started are synced again. It is removed once the manifest is saved."""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.journal_path = os.path.join(out_dir, JOURNAL_FILENAME)
+        self.lock = threading.Lock()
+        self.file = None
+        self.last_fsync = 0.0
+
+    def _key(self, path):
+        return os.path.relpath(path, self.out_dir)
+
+    def exists(self):
+        return os.path.exists(self.journal_path)
+
+    def replay(self, manifest, cache = None):
+        """Apply the journal of an interrupted run to manifest. Files that were done are recorded, and their album art
+        is marked as checked in cache for the cover size it was checked for, so they are not looked at again. Files that were started but not done are
+        marked incomplete, see SyncManifest.mark_incomplete. Returns (done, incomplete) counts."""
+        states = {}
+        with open(self.journal_path, 'r', encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break   # the last line was cut off by the interruption
+                states[record["path"]] = record
+
+        done = 0
+        incomplete = 0
+        for key, record in states.items():
+            out_path = os.path.join(self.out_dir, key)
+            if record["state"] == JOURNAL_DONE:
+                manifest.set_entry(out_path, record["entry"])
+                if cache is not None and record["art"] and os.path.exists(out_path):
+                    cache.set_art_ok(out_path, os.stat(out_path), record["art"])
+                done += 1
+            elif record["state"] == JOURNAL_STARTED:
+                manifest.mark_incomplete(out_path, record["source"])
+                if os.path.exists(out_path + ".part"):
+                    os.remove(out_path + ".part")
+                incomplete += 1
+        return done, incomplete
+
+    def open(self):
+        """Start a new journal, replacing the one that was replayed."""
+        self.file = open(self.journal_path, 'w', encoding="utf-8")
+        self.last_fsync = time.monotonic()
+
+    def _write(self, records, sync = False):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(lines)
+            self.file.flush()
+            if sync or time.monotonic() - self.last_fsync >= JOURNAL_FSYNC_SECONDS:
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.monotonic()
+
+    def planned(self, outPaths):
+        self._write([{"path": self._key(path), "state": JOURNAL_PLANNED} for path in outPaths], True)
+
+    def started(self, outPath, srcPath):
+        self._write([{"path": self._key(outPath), "state": JOURNAL_STARTED, "source": srcPath}])
+
+    def done(self, outPath, entry, artChecked):
+        """artChecked is the cover size the album art was checked for, or 0 if it was not checked."""
+        self._write([{"path": self._key(outPath), "state": JOURNAL_DONE, "entry": entry, "art": artChecked}])
+
+    def finish(self):
+        """Close and remove the journal, after the manifest was saved with everything in it."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        if self.exists():
+            os.remove(self.journal_path)
@@ -0,0 +1,216 @@
+import os
+import json
+import hashlib
+import threading
+from filesystem import LocalFileSystem
+
+MANIFEST_FILENAME = "sync_manifest.json"
+TRANSCODE_INCOMPLETE = "incomplete"    # writing it was interrupted, never matches so it is synced again
+
+class DirectoryListings:
+    """Lists every directory once with scandir, so files can be looked up without a stat round trip each.
+    Meant for the SMB share, where every separate exists/getmtime call is a network round trip."""
+
+    def __init__(self, fileSystem = None):
+        self.fileSystem = fileSystem or LocalFileSystem()
+        self.lock = threading.Lock()
+        self.dir_locks = {}
+        self.listings = {}
+
+    def _list(self, directory):
+        return self.fileSystem.scandir(directory)
+
+    def stat(self, path):
+        """Returns the stat result of path as seen when its directory was listed, or None if it does not exist."""
+        directory, name = os.path.split(path)
+        with self.lock:
+            dir_lock = self.dir_locks.setdefault(directory, threading.Lock())
+
+        with dir_lock:  # only one worker lists a directory, the others wait for its result
+            listing = self.listings.get(directory)
+            if listing is None:
+                listing = self._list(directory)
+                self.listings[directory] = listing
+        return listing.get(name)
+
+    def scan(self, root):
+        """List root and every folder below it, so later lookups in there need no listing of their own.
+        Returns a dict of path -> stat result of all files found."""
+        files = {}
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            subdirs = []
+            listing = self.fileSystem.scandir(directory, subdirs)
+            with self.lock:
+                self.listings[directory] = listing
+            files.update((os.path.join(directory, name), stat) for name, stat in listing.items())
+            directories.extend(os.path.join(directory, name) for name in subdirs)
+        return files
+
+class SyncManifest:
+    """Record of what was synced to the output device, stored in the out dir.
+    Files are keyed by their path relative to the out dir, so it does not matter where the device is mounted."""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.playlists = {}
+        self.written_playlists = set()
+        self.plex_playlists = {}
+        self.seen_plex_playlists = set()
+        self.profile = None     # name of the transcode profile the playlists were written for
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding="utf-8") as file:
+                data = json.load(file)
+                self.files = data.get("files", {})
+                self.playlists = data.get("playlists", {})
+                self.plex_playlists = data.get("plex_playlists", {})
+                self.profile = data.get("profile")
+
+    def _key(self, path):
+        return os.path.relpath(path, self.out_dir)
+
+    def is_up_to_date(self, outPath, srcPath, srcStat, transcode):
+        """True if outPath was synced from the same version of srcPath, with the same transcode settings."""
+        with self.lock:
+            entry = self.files.get(self._key(outPath))
+        return (
+            entry is not None
+            and entry["source"] == srcPath
+            and entry["size"] == srcStat.st_size
+            and entry["mtime"] == srcStat.st_mtime
+            and entry["transcode"] == transcode
+        )
+
+    def forget(self, outPath):
+        """Drop a file that was removed from the out dir."""
+        with self.lock:
+            self.files.pop(self._key(outPath), None)
+
+    def has_file(self, outPath):
+        with self.lock:
+            return self._key(outPath) in self.files
+
+    def record(self, outPath, srcPath, srcStat, transcode, outHash):
+        with self.lock:
+            self.files[self._key(outPath)] = {
+                "source": srcPath,
+                "size": srcStat.st_size,
+                "mtime": srcStat.st_mtime,
+                "transcode": transcode,
+                "hash": outHash,
+            }
+
+    def get_entry(self, outPath):
+        with self.lock:
+            entry = self.files.get(self._key(outPath))
+            return dict(entry) if entry is not None else None
+
+    def set_entry(self, outPath, entry):
+        with self.lock:
+            self.files[self._key(outPath)] = entry
+
+    def mark_incomplete(self, outPath, srcPath):
+        """Record that writing outPath was interrupted. It is synced again, and not adopted by its modification time."""
+        with self.lock:
+            self.files[self._key(outPath)] = {
+                "source": srcPath,
+                "size": None,
+                "mtime": None,
+                "transcode": TRANSCODE_INCOMPLETE,
+                "hash": None,
+            }
+
+    def update_hash(self, outPath, outHash):
+        """Update the hash of a synced file that was changed after copying, like when its album art was converted."""
+        with self.lock:
+            entry = self.files.get(self._key(outPath))
+            if entry is not None:
+                entry["hash"] = outHash
+
+    def get_plex_playlist(self, ratingKey, fingerprint):
+        """Returns the items stored for a plex playlist if its fingerprint did not change since, otherwise None."""
+        key = str(ratingKey)
+        self.seen_plex_playlists.add(key)
+        state = self.plex_playlists.get(key)
+        if state is None or state["fingerprint"] != fingerprint:
+            return None
+        return state["items"]
+
+    def set_plex_playlist(self, ratingKey, fingerprint, items):
+        key = str(ratingKey)
+        self.seen_plex_playlists.add(key)
+        self.plex_playlists[key] = {"fingerprint": fingerprint, "items": items}
+
+    def update_plex_playlist_items(self, ratingKey, items):
+        """Replace the stored items of a plex playlist, keeping its fingerprint."""
+        state = self.plex_playlists.get(str(ratingKey))
+        if state is not None:
+            state["items"] = items
+
+    def take_plex_playlist(self, ratingKey, other):
+        """Take the stored items of a plex playlist from the manifest of another out dir, that was synced from the same
+        fetch of plex. Returns True if the playlist did not change since this out dir was synced."""
+        key = str(ratingKey)
+        self.seen_plex_playlists.add(key)
+        state = other.plex_playlists.get(key)
+        if state is None:
+            return False
+        unchanged = self.plex_playlists.get(key, {}).get("fingerprint") == state["fingerprint"]
+        self.plex_playlists[key] = state
+        return unchanged
+
+    def keep_playlist(self, playlistPath, exists = None):
+        """Keep a playlist file that was written by an earlier run as is. Returns False if it has to be written again.
+        Pass exists if it is known whether the file is there, to save a stat call."""
+        key = self._key(playlistPath)
+        exists = os.path.exists(playlistPath) if exists is None else exists
+        with self.lock:
+            if key not in self.playlists or not exists:
+                return False
+            self.written_playlists.add(key)
+        return True
+
+    def write_playlist(self, playlistPath, content, exists = None):
+        """Write a playlist file with a single write, unless the same content was written to it before.
+        Its folder has to exist. Returns True if it was written."""
+        key = self._key(playlistPath)
+        content_hash = hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+        with self.lock:
+            self.written_playlists.add(key)
+            if self.playlists.get(key) == content_hash and (os.path.exists(playlistPath) if exists is None else exists):
+                return False
+
+        tmp_path = playlistPath + ".tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as file:
+            file.write(content)
+        os.replace(tmp_path, playlistPath)
+
+        with self.lock:
+            self.playlists[key] = content_hash
+        return True
+
+    def remove_stale_playlists(self, playlistDirs):
+        """Delete playlist files in playlistDirs that were not produced by this run, like deleted or renamed playlists."""
+        for playlistDir in playlistDirs:
+            if not os.path.exists(playlistDir):
+                continue
+            for name in os.listdir(playlistDir):
+                path = os.path.join(playlistDir, name)
+                key = self._key(path)
+                if key not in self.written_playlists and os.path.isfile(path):
+                    os.remove(path)
+                    self.playlists.pop(key, None)
+
+    def save(self):
+        with self.lock:
+            plex_playlists = {key: value for key, value in self.plex_playlists.items() if key in self.seen_plex_playlists}
+            data = {"files": self.files, "playlists": self.playlists, "plex_playlists": plex_playlists, "profile": self.profile}
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, 'w', encoding="utf-8") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.manifest_path)
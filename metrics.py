@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import math
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+# Optional, for --profile pyinstrument
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+PROFILER_CPROFILE = "cprofile"
+PROFILER_PYINSTRUMENT = "pyinstrument"
+# From Python 3.12 on cProfile is built on sys.monitoring, which allows only one active profiler and sees all threads
+PROFILE_THREADS = sys.version_info < (3, 12)
+
+def percentile(sortedValues, share):
+    """Nearest rank percentile of an already sorted list, share between 0 and 1."""
+    if not sortedValues:
+        return 0.0
+    index = min(max(math.ceil(share * len(sortedValues)) - 1, 0), len(sortedValues) - 1)
+    return sortedValues[index]
+
+class Metrics:
+    """Latencies of the expensive calls of a sync, and counters like bytes moved, shared by all worker threads.
+    Every call of a timed() block is kept, so percentiles are exact. That is one float per call, and there are
+    only a few calls per track."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Record how long the with block took under name, also when it raises."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self.lock:
+                self.latencies.setdefault(name, []).append(elapsed)
+
+    def wrap(self, name, func):
+        """func, with every call timed under name."""
+        def timed_func(*args, **kwargs):
+            with self.timed(name):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def stats(self, name):
+        with self.lock:
+            values = sorted(self.latencies.get(name, []))
+        return {
+            "count": len(values),
+            "total": sum(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "max": values[-1] if values else 0.0,
+        }
+
+    def report(self):
+        with self.lock:
+            names = sorted(self.latencies)
+            counters = dict(self.counters)
+        return {
+            "latencies": {name: self.stats(name) for name in names},
+            "counters": counters,
+        }
+
+    def summary(self):
+        lines = ['%-20s %8s %10s %10s %10s %10s' % ("", "count", "total s", "p50 ms", "p95 ms", "max ms")]
+        for name, stats in self.report()["latencies"].items():
+            lines.append('%-20s %8i %10.2f %10.1f %10.1f %10.1f' % (
+                name, stats["count"], stats["total"], stats["p50"] * 1000, stats["p95"] * 1000, stats["max"] * 1000,
+            ))
+        return "\n".join(lines)
+
+def write_report(path, report):
+    """Write a run report as json, replacing the one of the previous run."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    os.replace(tmp_path, path)
+
+def run_profiled(profiler, outputPath, func):
+    """Run func under cProfile or pyinstrument, and store the profile at outputPath plus .prof or .html.
+    Before Python 3.12 cProfile also profiles the threads func starts, each with its own profiler, and merges them
+    into one profile. From 3.12 on there can only be one, which also sees the calls of the other threads, mixed into
+    the call stack of the calling thread. pyinstrument only samples the calling thread. The album art processes are not profiled. Returns what func returns."""
+    if profiler == PROFILER_PYINSTRUMENT and pyinstrument is None:
+        print('pyinstrument is not installed, profiling with cProfile instead')
+        profiler = PROFILER_CPROFILE
+
+    if profiler == PROFILER_PYINSTRUMENT:
+        sampler = pyinstrument.Profiler(async_mode="disabled")
+        sampler.start()
+        try:
+            return func()
+        finally:
+            sampler.stop()
+            with open(outputPath + ".html", 'w', encoding="utf-8") as file:
+                file.write(sampler.output_html())
+            print(sampler.output_text())
+
+    thread_profiles = []
+    thread_profiles_lock = threading.Lock()
+
+    # The first event of every new thread replaces this hook with a profiler of its own
+    def start_thread_profile(frame, event, arg):
+        thread_profile = cProfile.Profile()
+        try:
+            thread_profile.enable()
+        except ValueError:
+            sys.setprofile(None)    # another profiler is active, this thread runs unprofiled
+            return
+        with thread_profiles_lock:
+            thread_profiles.append(thread_profile)
+
+    profile = cProfile.Profile()
+    if PROFILE_THREADS:
+        threading.setprofile(start_thread_profile)
+    profile.enable()
+    try:
+        return func()
+    finally:
+        profile.disable()
+        if PROFILE_THREADS:
+            threading.setprofile(None)
+        with thread_profiles_lock:
+            stats = pstats.Stats(profile, *thread_profiles)
+        stats.dump_stats(outputPath + ".prof")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(25)
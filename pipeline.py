@@ -0,0 +1,58 @@
+import queue
+import threading
+
+# Put on a queue after the last item, to tell the stage reading it to wind down
+DONE = object()
+
+class Stage:
+    """A step of the sync pipeline: `workers` threads call func for every item put on the stage,
+    and pass what it returns on to `outbox` (the inbox of the next stage, or a plain queue at the end).
+    Inboxes are bounded, so a stage that gets ahead blocks until the next one catches up.
+
+    func must not raise, failures should be recorded on the item so later stages can pass it on. A worker that
+    dies never passes on DONE, and everything after it waits forever."""
+
+    def __init__(self, name: str, func, workers: int, outbox: queue.Queue, maxsize: int):
+        self.func = func
+        self.inbox = queue.Queue(maxsize)
+        self.outbox = outbox
+        self.lock = threading.Lock()
+        self.running = max(workers, 1)
+        self.threads = [
+            threading.Thread(target=self._work, name="%s-%i" % (name, i), daemon=True)
+            for i in range(self.running)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    def close(self):
+        """Signal that no more items will be put on this stage."""
+        self.inbox.put(DONE)
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            if item is DONE:
+                self.inbox.put(DONE)    # pass it on to the other workers of this stage
+                with self.lock:
+                    self.running -= 1
+                    last = self.running == 0
+                if last:
+                    self.outbox.put(DONE)
+                return
+
+            self.outbox.put(self.func(item))
+
+def drain(results: queue.Queue):
+    """Yield everything that arrives on results, until the last stage is done."""
+    while True:
+        item = results.get()
+        if item is DONE:
+            return
+        yield item
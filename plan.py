@@ -0,0 +1,80 @@
+import os
+import shutil
+
+ACTION_COPY = "copy"
+ACTION_CONVERT = "convert"
+ACTION_KEEP = "keep"
+
+def format_bytes(size):
+    return '%.1f MB' % (size / 1000000) if abs(size) < 1000000000 else '%.2f GB' % (size / 1000000000)
+
+class SyncPlan:
+    """What a sync is going to do to the Music folder of the out dir, worked out before anything is written:
+    which files are copied or converted and how many bytes that takes, and which files no playlist uses anymore.
+
+    existingFiles is a single scan of the Music folder, path -> stat result, see DirectoryListings.scan."""
+
+    def __init__(self, musicDir: str, existingFiles: dict):
+        self.musicDir = musicDir
+        self.existingFiles = existingFiles
+        self.files = {ACTION_COPY: [], ACTION_CONVERT: [], ACTION_KEEP: []}
+        self.bytesNeeded = 0
+        self.orphans = []
+        self.orphanBytes = 0
+        device_dir = musicDir if os.path.exists(musicDir) else os.path.dirname(musicDir)    # not there before the first sync
+        self.free = shutil.disk_usage(device_dir).free if os.path.exists(device_dir) else None
+
+    def add_file(self, outPath: str, action: str, size: int = 0):
+        """Plan outPath, size is the (estimated) size it will have after syncing."""
+        self.files[action].append((outPath, size))
+        if action != ACTION_KEEP:
+            existing = self.existingFiles.get(outPath)
+            self.bytesNeeded += size - (existing.st_size if existing is not None else 0)
+
+    def find_orphans(self, wantedPaths: set):
+        """Every file in the Music folder that is not in wantedPaths, like tracks that left all playlists."""
+        self.orphans = sorted(path for path in self.existingFiles if path not in wantedPaths)
+        self.orphanBytes = sum(self.existingFiles[path].st_size for path in self.orphans)
+
+    def fits(self):
+        """True if the planned files fit on the device once the orphans are removed. True if the free space is unknown."""
+        return self.free is None or self.bytesNeeded <= self.free + self.orphanBytes
+
+    def remove_orphans(self, manifest):
+        """Delete the orphans, their manifest entries, and folders that are empty afterwards."""
+        folders = set()
+        for path in self.orphans:
+            os.remove(path)
+            manifest.forget(path)
+            folders.add(os.path.dirname(path))
+
+        # Deepest first, so an artist folder is empty once its album folders are gone
+        for folder in sorted(folders, key=len, reverse=True):
+            while folder.startswith(self.musicDir + os.sep) and os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+
+    def summary(self, verbose: bool = False):
+        lines = []
+        if verbose:
+            for action in [ACTION_COPY, ACTION_CONVERT]:
+                for path, size in self.files[action]:
+                    lines.append('%-8s %s (%s)' % (action, os.path.relpath(path, self.musicDir), format_bytes(size)))
+            for path in self.orphans:
+                lines.append('%-8s %s (%s)' % ("delete", os.path.relpath(path, self.musicDir), format_bytes(self.existingFiles[path].st_size)))
+
+        lines.append('Plan: copy %i files (%s), convert %i files (about %s), %i up to date, delete %i orphans (%s).' % (
+            len(self.files[ACTION_COPY]), format_bytes(sum(size for _, size in self.files[ACTION_COPY])),
+            len(self.files[ACTION_CONVERT]), format_bytes(sum(size for _, size in self.files[ACTION_CONVERT])),
+            len(self.files[ACTION_KEEP]),
+            len(self.orphans), format_bytes(self.orphanBytes),
+        ))
+        if self.free is not None:
+            net = self.bytesNeeded - self.orphanBytes
+            lines.append('%s %s, %s free on the device%s.' % (
+                "Needs" if net >= 0 else "Frees",
+                format_bytes(abs(net)),
+                format_bytes(self.free),
+                "" if self.fits() else ", which is not enough",
+            ))
+        return "\n".join(lines)
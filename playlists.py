@@ -0,0 +1,96 @@
+import os
+import urllib.parse
+from xml.sax.saxutils import escape
+
+class PlaylistColumns:
+    """The fields of the items of a playlist that the formats need, as one list per field.
+    Built once per playlist and shared by all formats, so every format is a single join over these lists.
+    extensions are the extensions of tracks that are converted to another format on the device, by row."""
+
+    def __init__(self, playlistItems: list, extensions: dict = None):
+        self.titles = [item.title for item in playlistItems]
+        self.durations = [int(item.duration) for item in playlistItems]    # in seconds
+        self.relPaths = [item.playlistRelPath for item in playlistItems]
+        self.absPaths = [item.playlistAbsPath for item in playlistItems]
+        if extensions:
+            rows = [item.row for item in playlistItems]
+            self.relPaths = [change_extension(path, extensions.get(row)) for row, path in zip(rows, self.relPaths)]
+            self.absPaths = [change_extension(path, extensions.get(row)) for row, path in zip(rows, self.absPaths)]
+
+def change_extension(path: str, extension: str = None):
+    return os.path.splitext(path)[0] + extension if extension is not None else path
+
+# Abstract paths (the root is the out dir) and no information, as .m3u. For the Peugeot e-208 infotainment system
+def render_m3u_simple_abstract(playlistTitle: str, columns: PlaylistColumns):
+    return "".join("%s\n" % path for path in columns.absPaths)
+
+# Relative paths and extended info, as .m3u8. Main format for most players, like Rockbox and Mazda Connect
+def render_m3u8_extended_relative(playlistTitle: str, columns: PlaylistColumns):
+    return '#EXTM3U\n#PLAYLIST:%s\n\n' % playlistTitle + "".join(
+        '#EXTINF:%s,%s\n%s\n\n' % entry for entry in zip(columns.durations, columns.titles, columns.relPaths)
+    )
+
+# Absolute paths from the root of the device and extended info, as .m3u8. For Rockbox with the playlists
+# somewhere else than next to the Music folder, like in its own playlist catalog
+def render_m3u8_extended_absolute(playlistTitle: str, columns: PlaylistColumns):
+    return '#EXTM3U\n#PLAYLIST:%s\n\n' % playlistTitle + "".join(
+        '#EXTINF:%s,%s\n%s\n\n' % entry for entry in zip(columns.durations, columns.titles, columns.absPaths)
+    )
+
+def render_pls(playlistTitle: str, columns: PlaylistColumns):
+    entries = "".join(
+        'File%i=%s\nTitle%i=%s\nLength%i=%i\n' % (number, path, number, title, number, duration)
+        for number, (path, title, duration) in enumerate(zip(columns.relPaths, columns.titles, columns.durations), 1)
+    )
+    return '[playlist]\n%sNumberOfEntries=%i\nVersion=2\n' % (entries, len(columns.titles))
+
+def render_xspf(playlistTitle: str, columns: PlaylistColumns):
+    tracks = "".join(
+        '    <track><location>%s</location><title>%s</title><duration>%i</duration></track>\n' % (
+            escape(urllib.parse.quote(path.replace(os.sep, "/"))), escape(title), duration * 1000,
+        )
+        for path, title, duration in zip(columns.relPaths, columns.titles, columns.durations)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+        '  <title>%s</title>\n  <trackList>\n%s  </trackList>\n</playlist>\n'
+    ) % (escape(playlistTitle), tracks)
+
+# The playlist formats that can be written, config key -> (folder in the out dir, extension, renderer).
+# A renderer gets the playlist title and its PlaylistColumns, and returns the whole file as one string.
+# Folders of formats that are turned off are emptied, like for playlists that are gone.
+PLAYLIST_FORMATS = {
+    "sync_extended_relative": ("Playlists", ".m3u8", render_m3u8_extended_relative),
+    "sync_simple_abstract": ("Playlists_SimpleAbstract", ".m3u", render_m3u_simple_abstract),
+    "sync_extended_absolute": ("Playlists_Absolute", ".m3u8", render_m3u8_extended_absolute),
+    "sync_pls": ("Playlists_PLS", ".pls", render_pls),
+    "sync_xspf": ("Playlists_XSPF", ".xspf", render_xspf),
+}
+
+def get_playlist_folders(outDir: str):
+    return [os.path.join(outDir, folder) for folder, _, _ in PLAYLIST_FORMATS.values()]
+
+def render_playlists(fetchedPlaylists, formats: list, outDir: str, manifest, extensions: dict = None):
+    """Write every playlist in every format in formats (config keys of PLAYLIST_FORMATS) in one pass.
+    fetchedPlaylists are (title, items, unchanged), extensions are passed on to PlaylistColumns. Every format folder is created and listed once, and files are
+    written in one go, only if their content changed, see SyncManifest.write_playlist. Yields the title of every
+    playlist once it is written."""
+    folders = {key: os.path.join(outDir, PLAYLIST_FORMATS[key][0]) for key in formats}
+    existing = {}
+    for key, folder in folders.items():
+        os.makedirs(folder, exist_ok=True)
+        existing[key] = set(os.listdir(folder))
+
+    for playlistTitle, playlistItems, unchanged in fetchedPlaylists:
+        columns = None
+        for key in formats:
+            _, extension, render = PLAYLIST_FORMATS[key]
+            file_name = playlistTitle + extension
+            playlistPath = os.path.join(folders[key], file_name)
+            exists = file_name in existing[key]
+            if unchanged and manifest.keep_playlist(playlistPath, exists):
+                continue
+            columns = columns or PlaylistColumns(playlistItems, extensions)
+            manifest.write_playlist(playlistPath, render(playlistTitle, columns), exists)
+        yield playlistTitle
@@ -0,0 +1,62 @@
+"""A stand-in for a Plex server, with the parts of the plexapi PlexServer that PlexPlaylistSync uses.
+Serves playlists of files from memory, so syncs can be run and timed without a Plex server."""
+import datetime
+from xml.etree import ElementTree
+
+class StubTrack:
+    def __init__(self, ratingKey: str, title: str, duration: int, file: str, updatedAt: int = 0):
+        self.ratingKey = ratingKey
+        self.title = title
+        self.duration = duration    # in ms, like plex
+        self.file = file    # path as known to plex
+        self.updatedAt = updatedAt
+
+class StubPlaylist:
+    def __init__(self, ratingKey: int, title: str, tracks: list[StubTrack], updatedAt: datetime.datetime = None):
+        self.ratingKey = ratingKey
+        self.key = '/playlists/%i' % ratingKey
+        self.title = title
+        self.playlistType = 'audio'
+        self.tracks = tracks
+        self.updatedAt = updatedAt or datetime.datetime(2024, 1, 1)
+
+    @property
+    def leafCount(self):
+        return len(self.tracks)
+
+    @property
+    def duration(self):
+        return sum(track.duration for track in self.tracks)
+
+    def edit(self, tracks: list[StubTrack]):
+        """Replace the tracks, and bump updatedAt like plex does."""
+        self.tracks = tracks
+        self.updatedAt += datetime.timedelta(seconds=1)
+
+class StubPlex:
+    def __init__(self, playlists: list[StubPlaylist]):
+        self.playlistsByKey = {playlist.key: playlist for playlist in playlists}
+        self.queries = 0
+
+    def playlists(self):
+        return list(self.playlistsByKey.values())
+
+    def query(self, key: str, params: dict = None):
+        """Only answers '<playlist key>/items', with the same xml as plex."""
+        self.queries += 1
+        playlist = self.playlistsByKey[key[:-len('/items')]]
+        params = params or {}
+        start = int(params.get('X-Plex-Container-Start', 0))
+        size = int(params.get('X-Plex-Container-Size', len(playlist.tracks)))
+
+        container = ElementTree.Element('MediaContainer')
+        for track in playlist.tracks[start:start + size]:
+            element = ElementTree.SubElement(container, 'Track', {
+                'ratingKey': track.ratingKey,
+                'title': track.title,
+                'duration': str(track.duration),
+                'updatedAt': str(track.updatedAt),
+            })
+            media = ElementTree.SubElement(element, 'Media')
+            ElementTree.SubElement(media, 'Part', {'file': track.file})
+        return container
@@ -0,0 +1,149 @@
+from array import array
+from utils import rename_filename_keep_extension
+
+class TrackTable:
+    """Every unique track of all playlists, stored once as columns: its path relative to the plex music root,
+    its title and the plex fields. A path is interned here the first time a playlist references it, and all
+    references after that share the row.
+
+    Playlists are TrackLists, arrays of rows, and PlaylistItem is a view on a row that works out the fs, out and
+    playlist paths from the relative path when they are read. Only the relative path with the title as file name
+    is kept once it is worked out, the prefixed variants are a concatenation. So a track in ten playlists costs one
+    row and ten array slots, instead of ten objects with seven strings each."""
+
+    def __init__(self, plexMusicRoot: str, fsMusicRoot: str, outMusicDir: str, playlistRelDir: str, playlistAbsDir: str):
+        self.plexMusicRoot = plexMusicRoot
+        self.fsMusicRoot = fsMusicRoot
+        self.outMusicDir = outMusicDir
+        self.playlistRelDir = playlistRelDir
+        self.playlistAbsDir = playlistAbsDir
+        self.rows = {}  # relative path -> row
+        self.unrooted = {}  # plex path -> row, for tracks outside of plexMusicRoot
+        self.relPaths = []  # relative to plexMusicRoot, or the plex path if the track is outside of it
+        self.rooted = bytearray()   # 1 if the track is below plexMusicRoot
+        self.renamedPaths = []  # relPaths with the title as file name, filled in when first needed
+        self.titles = []
+        self.durations = array('q')  # in ms, like plex
+        self.ratingKeys = []
+        self.updatedAts = []
+        self.updated = set()    # rows whose plex data changed after they were added, see add()
+
+    def __len__(self):
+        return len(self.relPaths)
+
+    def add(self, title: str, duration: int, plexFile: str, ratingKey: str = None, updatedAt: str = None, fetched: bool = False):
+        """Returns the row of the track, adding it if no playlist referenced it before.
+        If it was added before with other data, the row is kept in updated. Pass fetched for data that was just
+        fetched from plex, that replaces the data of the row, like of the items of unchanged playlists from the manifest."""
+        # title is also used as filename, filter some characters
+        # why title = filename? Because some players display the filename instead of reading the id3 tag...
+        title = title.replace(':', '_').replace('/', '_').replace('?', '')
+        rooted = plexFile.startswith(self.plexMusicRoot)
+        rows = self.rows if rooted else self.unrooted
+        key = plexFile[len(self.plexMusicRoot):] if rooted else plexFile
+        row = rows.get(key)
+        if row is not None:
+            if (self.titles[row], self.durations[row], self.updatedAts[row]) != (title, duration, updatedAt):
+                self.updated.add(row)
+                if fetched:
+                    self.titles[row] = title
+                    self.durations[row] = duration
+                    self.ratingKeys[row] = ratingKey
+                    self.updatedAts[row] = updatedAt
+                    self.renamedPaths[row] = None
+            return row
+
+        row = len(self.relPaths)
+        rows[key] = row
+        self.relPaths.append(key)
+        self.rooted.append(rooted)
+        self.renamedPaths.append(None)
+        self.titles.append(title)
+        self.durations.append(duration)
+        self.ratingKeys.append(ratingKey)
+        self.updatedAts.append(updatedAt)
+        return row
+
+    def path(self, row: int, root: str):
+        """The path of the track below root, where root takes the place of the plex music root.
+        Tracks outside of the plex music root keep their plex path."""
+        relPath = self.relPaths[row]
+        return root + relPath if self.rooted[row] else relPath
+
+    def renamed_path(self, row: int, root: str):
+        """Like path(), with the title as file name, the way the track is stored on the device."""
+        renamedPath = self.renamedPaths[row]
+        if renamedPath is None:
+            renamedPath = rename_filename_keep_extension(self.relPaths[row], self.titles[row])
+            self.renamedPaths[row] = renamedPath
+        return root + renamedPath if self.rooted[row] else renamedPath
+
+class PlaylistItem:
+    """A track of a playlist, as a view on its row of a TrackTable. Only the table and the row are stored."""
+    __slots__ = ("tracks", "row")
+
+    def __init__(self, tracks: TrackTable, row: int):
+        self.tracks = tracks
+        self.row = row
+
+    @property
+    def title(self):
+        return self.tracks.titles[self.row]
+
+    @property
+    def duration(self):
+        return self.tracks.durations[self.row] / 1000 # conv to seconds
+
+    @property
+    def ratingKey(self):
+        return self.tracks.ratingKeys[self.row] # plex id of the track
+
+    @property
+    def updatedAt(self):
+        return self.tracks.updatedAts[self.row]
+
+    @property
+    def plexPath(self):
+        # Path to music dir as known to plex, on your server, could be in docker or smth
+        return self.tracks.path(self.row, self.tracks.plexMusicRoot)
+
+    @property
+    def fsPath(self):
+        # Path to music dir as known to the filesystem, this could be different from plex.
+        return self.tracks.path(self.row, self.tracks.fsMusicRoot)
+
+    @property
+    def outPath(self):
+        # Path to music dir where the music should be copied to.
+        return self.tracks.renamed_path(self.row, self.tracks.outMusicDir)
+
+    @property
+    def playlistRelPath(self):
+        # from the perspective of the playlist, path to the music dir. The playlists point at the renamed file too
+        return self.tracks.renamed_path(self.row, self.tracks.playlistRelDir)
+
+    @property
+    def playlistAbsPath(self):
+        # from the root dir, path to the music dirs
+        return self.tracks.renamed_path(self.row, self.tracks.playlistAbsDir)
+
+class TrackList:
+    """The items of a playlist, as an array of rows of a TrackTable. Yields PlaylistItems."""
+    __slots__ = ("tracks", "rows")
+
+    def __init__(self, tracks: TrackTable, rows = ()):
+        self.tracks = tracks
+        self.rows = array('I', rows)
+
+    def append(self, row: int):
+        self.rows.append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        tracks = self.tracks
+        return (PlaylistItem(tracks, row) for row in self.rows)
+
+    def __getitem__(self, index):
+        return PlaylistItem(self.tracks, self.rows[index])
@@ -0,0 +1,303 @@
+import os
+import shutil
+import tempfile
+import base64
+import threading
+from utils import MAX_SIZE, DEFAULT_CONFIG, convert_audio, convert_album_art_image_baseline_jpeg, hash_file, probe_audio
+from mutagen.flac import FLAC, Picture
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.oggopus import OggOpus
+
+# Optional, for converting FLAC files without starting ffmpeg
+try:
+    import numpy
+    import soundfile
+except ImportError:
+    numpy = None
+    soundfile = None
+
+TRANSCODE_BLOCK_SIZE = 65536
+BACKEND_FFMPEG = "ffmpeg"
+BACKEND_SOUNDFILE = "soundfile"
+
+CODEC_KEEP = "keep"
+CODEC_FLAC = "flac"
+CODEC_OPUS = "opus"
+CODEC_AAC = "aac"
+TRANSCODE_CODECS = [CODEC_KEEP, CODEC_FLAC, CODEC_OPUS, CODEC_AAC]
+LOSSY_CODECS = {CODEC_OPUS: (".opus", "libopus", 128), CODEC_AAC: (".m4a", "aac", 256)}  # extension, ffmpeg encoder, default kbps
+LOSSLESS_EXTENSIONS = {".flac", ".wav", ".aif", ".aiff"}   # .m4a can be lossless ALAC as well as lossy AAC, that needs a probe
+LOSSLESS_ENCODERS = {".flac": "flac", ".m4a": "alac", ".wav": "pcm_s%ile", ".aif": "pcm_s%ibe", ".aiff": "pcm_s%ibe"}
+
+class TranscodeProfile:
+    """What the files are converted to for one device, from the transcode keys of its config.
+    Lossless files are kept within maxBitDepth and maxSampleRate, in their own format, or in FLAC with codec flac.
+    With codec opus or aac they are encoded to that at bitrate kbps instead. Lossy files are always copied as they
+    are, encoding them again only loses quality. Covers are made baseline jpegs of at most coverSize."""
+
+    def __init__(self, codec: str = CODEC_KEEP, bitrate: int = None, maxBitDepth: int = 16, maxSampleRate: int = None, coverSize: int = MAX_SIZE):
+        self.codec = codec
+        self.lossy = codec in LOSSY_CODECS
+        self.bitrate = (bitrate or LOSSY_CODECS[codec][2]) if self.lossy else None
+        self.maxBitDepth = maxBitDepth
+        self.maxSampleRate = maxSampleRate or None
+        self.coverSize = coverSize
+
+    @staticmethod
+    def from_config(config):
+        return TranscodeProfile(
+            config.transcode_codec or DEFAULT_CONFIG.transcode_codec,
+            config.transcode_bitrate_kbps,
+            config.max_bit_depth or DEFAULT_CONFIG.max_bit_depth,
+            config.max_sample_rate,
+            config.cover_size or DEFAULT_CONFIG.cover_size,
+        )
+
+    @property
+    def name(self):
+        """Identifies the output in the manifest and the transcode cache, so changing the profile syncs the files again.
+        The default profile is "16bit", what the only conversion there was used to be called."""
+        if self.lossy:
+            parts = [self.codec, "%ik" % self.bitrate]
+            if self.coverSize != MAX_SIZE:
+                parts.append("%ipx" % self.coverSize)   # the cover is embedded when it is encoded
+        else:
+            parts = [self.codec] if self.codec != CODEC_KEEP else []
+            parts.append("%ibit" % self.maxBitDepth)
+        if self.maxSampleRate and self.codec != CODEC_OPUS:
+            parts.append("%ihz" % self.maxSampleRate)
+        return "-".join(parts)
+
+    def output_extension(self, extension: str, probe = None):
+        """The extension a file with extension gets on the device. Only lossless files change format: those with a
+        bit depth if the file is probed, otherwise the ones that are lossless by their extension."""
+        lossless = probe.bit_depth is not None if probe is not None else extension.lower() in LOSSLESS_EXTENSIONS
+        if lossless:
+            if self.lossy:
+                return LOSSY_CODECS[self.codec][0]
+            if self.codec == CODEC_FLAC:
+                return ".flac"
+        return extension
+
+    def output_path(self, path: str, probe = None):
+        base, extension = os.path.splitext(path)
+        output_extension = self.output_extension(extension, probe)
+        return path if output_extension == extension else base + output_extension
+
+    def bit_depth(self, probe):
+        return min(probe.bit_depth, self.maxBitDepth)
+
+    def sample_rate(self, probe):
+        """Halves the sample rate while it is over the limit, so 88.2 and 176.4 kHz become 44.1 kHz and 96 and 192
+        kHz become 48 kHz, instead of resampling them all to the limit. Opus always is 48 kHz."""
+        if self.codec == CODEC_OPUS:
+            return 48000
+        rate = probe.sample_rate
+        if not self.maxSampleRate or not rate:
+            return rate
+        while rate > self.maxSampleRate and rate % 2 == 0 and rate // 2 >= 44100:
+            rate //= 2
+        return min(rate, self.maxSampleRate)
+
+    def needs_transcode(self, probe, path: str):
+        """True if the file at path, as probed, has to be converted. Lossy files (no bit depth) never are."""
+        if probe is None or probe.bit_depth is None:
+            return False
+        if self.lossy or self.output_path(path, probe) != path:
+            return True
+        return probe.bit_depth > self.maxBitDepth or self.sample_rate(probe) != probe.sample_rate
+
+    def estimate_size(self, size: int, probe):
+        """Rough size of the converted file, for planning."""
+        if self.lossy and probe.duration:
+            return int(self.bitrate * 125 * probe.duration)
+        size = size * self.bit_depth(probe) // probe.bit_depth
+        rate = self.sample_rate(probe)
+        if rate and probe.sample_rate:
+            size = size * rate // probe.sample_rate
+        return size
+
+    def ffmpeg_options(self, probe, extension: str):
+        """The ffmpeg output options that convert a file with extension, as probed, to this profile."""
+        rate = self.sample_rate(probe)
+        options = ['-ar', str(rate)] if rate and rate != probe.sample_rate else []
+        if self.lossy:
+            # Covers are added afterwards, ogg cannot take them from ffmpeg
+            return ['-map', '0:a', '-c:a', LOSSY_CODECS[self.codec][1], '-b:a', '%ik' % self.bitrate] + options
+
+        extension = self.output_extension(extension, probe).lower()
+        bits = self.bit_depth(probe)
+        encoder = LOSSLESS_ENCODERS.get(extension, "flac")
+        if "%i" in encoder:
+            return ['-vn', '-c:a', encoder % (24 if bits > 16 else 16)] + options
+        sample_fmt = "s16" if bits <= 16 else "s32"
+        if encoder == "alac":
+            sample_fmt += "p"
+        return ['-c:a', encoder, '-sample_fmt', sample_fmt, '-c:v', 'copy'] + options
+
+def read_cover(path):
+    """The embedded cover of a lossless file as image bytes, or None."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".flac":
+        pictures = FLAC(path).pictures
+        return pictures[0].data if pictures else None
+    if extension == ".m4a":
+        tags = MP4(path).tags
+        return bytes(tags["covr"][0]) if tags is not None and "covr" in tags else None
+    return None
+
+def embed_cover(path, image_data):
+    """Add a cover to an encoded .opus or .m4a file."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".opus":
+        audio = OggOpus(path)
+        picture = Picture()
+        picture.type = 3
+        picture.mime = "image/jpeg"
+        picture.data = image_data
+        audio["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
+    elif extension == ".m4a":
+        audio = MP4(path)
+        if audio.tags is None:
+            audio.add_tags()
+        audio.tags["covr"] = [MP4Cover(image_data, imageformat=MP4Cover.FORMAT_JPEG)]
+    else:
+        return
+    audio.save()
+
+def copy_flac_tags(input_path, output_path):
+    """Copy the vorbis comments and pictures of one FLAC file to another."""
+    src = FLAC(input_path)
+    dst = FLAC(output_path)
+    if dst.tags is None:
+        dst.add_tags()
+    for key, value in (src.tags or []):
+        dst.tags.append((key, value))
+    for picture in src.pictures:
+        dst.add_picture(picture)
+    dst.save()
+
+def convert_flac_to_16bit_soundfile(input_path, output_path):
+    """Convert a FLAC file to 16 bit FLAC in this process, with TPDF dither.
+    Works through the file in blocks, so high resolution files are never fully in memory."""
+    rng = numpy.random.default_rng()
+    with soundfile.SoundFile(input_path) as src, soundfile.SoundFile(
+        output_path, 'w', samplerate=src.samplerate, channels=src.channels, subtype='PCM_16', format='FLAC'
+    ) as dst:
+        for block in src.blocks(blocksize=TRANSCODE_BLOCK_SIZE, dtype='float64', always_2d=True):
+            # Difference of two uniform distributions is triangular, +-1 LSB
+            dither = rng.random(block.shape) - rng.random(block.shape)
+            samples = numpy.round(block * 32768 + dither)
+            dst.write(numpy.clip(samples, -32768, 32767).astype(numpy.int16))
+    copy_flac_tags(input_path, output_path)
+
+class Transcoder:
+    """Converts files to a TranscodeProfile with at most `jobs` conversions at the same time.
+    Files are converted in a local staging dir and checked there, only a verified result is handed out to be
+    copied to the out dirs, so a failed conversion never ends up on the device."""
+
+    def __init__(self, jobs: int, stagingDir: str = None, backend: str = BACKEND_FFMPEG, fastProbe: bool = True, cache = None, artCache = None):
+        self.jobs = max(jobs, 1)
+        self.slots = threading.Semaphore(self.jobs)
+        self.stagingDir = tempfile.mkdtemp(prefix="PlexPlaylistSync-", dir=stagingDir)
+        self.useSoundfile = backend == BACKEND_SOUNDFILE and soundfile is not None
+        self.fastProbe = fastProbe
+        self.cache = cache  # cache.TranscodeCache, or None
+        self.artCache = artCache    # cache.ArtCache for the covers of encoded files, or None
+
+    def _backend(self, input_path, profile: TranscodeProfile, sourceProbe = None):
+        # soundfile only does FLAC to 16 bit FLAC, without resampling
+        if self.useSoundfile and input_path.lower().endswith(".flac") and not profile.lossy and profile.maxBitDepth == 16 \
+            and (sourceProbe is None or profile.sample_rate(sourceProbe) == sourceProbe.sample_rate):
+            return BACKEND_SOUNDFILE
+        return BACKEND_FFMPEG
+
+    def _convert(self, input_path, staged_path, profile: TranscodeProfile, sourceProbe):
+        if self._backend(input_path, profile, sourceProbe) == BACKEND_SOUNDFILE:
+            convert_flac_to_16bit_soundfile(input_path, staged_path)
+        else:
+            convert_audio(input_path, staged_path, profile.ffmpeg_options(sourceProbe, os.path.splitext(input_path)[1]))
+
+        if profile.lossy:
+            cover = read_cover(input_path)
+            if cover is not None:
+                embed_cover(staged_path, convert_album_art_image_baseline_jpeg(cover, self.artCache, profile.coverSize))
+
+    def _verify(self, staged_path, sourceProbe, profile: TranscodeProfile):
+        if not os.path.exists(staged_path):
+            return False
+        probe = probe_audio(staged_path, self.fastProbe)
+        if probe is None:
+            return False
+        if profile.lossy:
+            if probe.codec != profile.codec:
+                return False
+        elif probe.bit_depth is None or probe.bit_depth > profile.maxBitDepth \
+            or (sourceProbe is not None and probe.sample_rate != profile.sample_rate(sourceProbe)):
+            return False
+        # A conversion that was cut short still has the right format, compare the duration with the source as well
+        if sourceProbe is not None and sourceProbe.duration and probe.duration:
+            return abs(probe.duration - sourceProbe.duration) < 1
+        return True
+
+    def _cache_key(self, input_path, sourceStat, profile: TranscodeProfile, sourceProbe = None):
+        if self.cache is None or sourceStat is None:
+            return None
+        return self.cache.key(input_path, sourceStat, "%s-%s" % (self._backend(input_path, profile, sourceProbe), profile.name))
+
+    def has_cached(self, input_path, sourceStat, profile: TranscodeProfile, sourceProbe = None):
+        """True if there is a cached conversion of input_path, so it does not have to be read at all."""
+        cache_key = self._cache_key(input_path, sourceStat, profile, sourceProbe)
+        return cache_key is not None and self.cache.has(cache_key, os.path.splitext(profile.output_path(input_path, sourceProbe))[1])
+
+    def transcode(self, input_path, profile: TranscodeProfile, sourceProbe, sourceStat = None, readPath = None):
+        """Convert input_path to profile in the staging dir. Returns the staged file and its hash, or (None, None) if
+        the conversion failed. The staged file can be copied to any number of out dirs, remove it with release().
+        If there is a cache and sourceStat is given, earlier conversions of the same source are reused.
+        readPath is a local copy of input_path to read instead, input_path still identifies it in the cache."""
+        ext = os.path.splitext(profile.output_path(input_path, sourceProbe))[1]
+        fd, staged_path = tempfile.mkstemp(dir=self.stagingDir, suffix=ext)
+        os.close(fd)
+        cache_key = self._cache_key(input_path, sourceStat, profile, sourceProbe)
+        if cache_key is not None:
+            cached_path = self.cache.get(cache_key, ext)
+            if cached_path is not None:
+                try:
+                    link_or_copy(cached_path, staged_path)  # it can be evicted while the out dirs are written
+                    return staged_path, hash_file(staged_path)
+                except FileNotFoundError:
+                    pass    # evicted in the meantime, convert it again
+
+        try:
+            with self.slots:
+                self._convert(readPath or input_path, staged_path, profile, sourceProbe)
+            if not self._verify(staged_path, sourceProbe, profile):
+                self.release(staged_path)
+                return None, None
+
+            out_hash = hash_file(staged_path)   # reading it back from local disk is cheaper than from the device
+            if cache_key is not None:
+                try:
+                    self.cache.put(cache_key, ext, staged_path)
+                except OSError:
+                    pass    # only costs a conversion next time, counted in the summary of the cache
+            return staged_path, out_hash
+        except BaseException:
+            self.release(staged_path)
+            raise
+
+    def release(self, staged_path):
+        """Remove a file returned by transcode."""
+        if staged_path is not None and os.path.exists(staged_path):
+            os.remove(staged_path)
+
+    def close(self):
+        shutil.rmtree(self.stagingDir, ignore_errors=True)
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, replacing dst, or copy it if they are on different file systems."""
+    try:
+        os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
@@ -1,12 +1,22 @@
 import json
+import time
+import hashlib
+import contextlib
 import os
 import io
 import re
-import shutil
 import argparse
 import socket
+import struct
 import subprocess
+import tempfile
 from PIL import Image
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+from mutagen.flac import FLAC
+from mutagen.mp4 import MP4
+from mutagen.wave import WAVE
+from mutagen.oggopus import OggOpus
 
 class Config(dict):
     def __getattr__(self, item):
@@ -24,9 +34,32 @@ DEFAULT_CONFIG = Config({
     "host": "http://plex.jn:32400",
     "sync_extended_relative": True,
     "sync_simple_abstract": False,
+    "sync_extended_absolute": False,
+    "sync_pls": False,
+    "sync_xspf": False,
     "token": None,
     "skip_album_art_checks": False,
     "warn_lossy_format": False,
+    "fast_probe": True,
+    "album_art_cache_dir": None,
+    "art_jobs": 4,
+    "art_processes": False,
+    "jobs": 4,
+    "transcode_jobs": os.cpu_count() or 1,
+    "transcode_backend": "ffmpeg",
+    "transcode_codec": "keep",
+    "transcode_bitrate_kbps": None,
+    "max_bit_depth": 16,
+    "max_sample_rate": None,
+    "cover_size": 512,
+    "staging_dir": None,
+    "transcode_cache_dir": None,
+    "transcode_cache_max_gb": 10,
+    "copy_buffer_mb": 8,
+    "read_ahead": 4,
+    "fsync": "end",
+    "smb_username": None,
+    "smb_password": None,
     "ignore_playlists": [
         "All Music",
         "Recently Added",
@@ -34,13 +67,19 @@ DEFAULT_CONFIG = Config({
     ]
 })
 
+# Arguments that only apply to the current run and are not saved to the config
+RUN_ONLY_ARGS = ["out_dir", "prune_cache", "profile", "dry_run"]
+
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         'out_dir',
         type = str,
-        help = "Root dir for the output files. This can be your flash drive, iPod or a local directory.",
-        default = "out"
+        nargs = '*',
+        help = "Root dir for the output files. This can be your flash drive, iPod or a local directory. "
+            "Give several to sync them all in one run, every file is then read from the library and converted only once. "
+            "Every out dir has its own config, options given here are saved to all of them.",
+        default = ["out"],
     )
     parser.add_argument(
         '--fs-music-root',
@@ -72,6 +111,21 @@ def parse_args():
         type = bool,
         help = "Creates playlist files with abstract paths (root = out-dir) and no information, as .m3u. Recommended for Peugeot infotainment system (e-208)",
     )
+    parser.add_argument(
+        '--sync-extended-absolute',
+        type = bool,
+        help = "Creates playlist files with absolute paths (root = out-dir) and extended information, as .m3u8 in Playlists_Absolute. For Rockbox when the playlists are moved elsewhere on the device.",
+    )
+    parser.add_argument(
+        '--sync-pls',
+        type = bool,
+        help = "Creates .pls playlist files with relative paths, in Playlists_PLS.",
+    )
+    parser.add_argument(
+        '--sync-xspf',
+        type = bool,
+        help = "Creates .xspf playlist files with relative paths, in Playlists_XSPF.",
+    )
     parser.add_argument(
         '--skip-album-art-checks',
         type = bool,
@@ -82,8 +136,141 @@ def parse_args():
         type = bool,
         help = "Adds warnings for lossy formats (like mp3, ogg and some m4a) in the output. Only useful if you want to identify lossy files in your music library.",
     )
+    parser.add_argument(
+        '--album-art-cache-dir',
+        type = str,
+        help = "Local directory to keep converted album art in between runs, so every distinct cover is only converted once. Converted covers are always cached in memory during a run.",
+    )
+    parser.add_argument(
+        '--art-jobs',
+        type = int,
+        help = "Amount of files of which the album art is checked at the same time.",
+    )
+    parser.add_argument(
+        '--art-processes',
+        type = bool,
+        help = "Checks album art in separate processes instead of threads, so decoding and resizing covers can use all cores.",
+    )
+    parser.add_argument(
+        '--fast-probe',
+        type = bool,
+        help = "Reads bit depth and other stream info from the file headers with mutagen, instead of starting ffprobe for every file. Falls back to ffprobe for files mutagen cannot read.",
+    )
+    parser.add_argument(
+        '--jobs',
+        type = int,
+        help = "Amount of files that are synced at the same time. Copying is mostly waiting on the network share and flash drive, so this can be higher than your core count.",
+    )
+    parser.add_argument(
+        '--transcode-jobs',
+        type = int,
+        help = "Maximum amount of ffmpeg conversions running at the same time, limited separately from --jobs because they are CPU bound. Defaults to the core count.",
+    )
+    parser.add_argument(
+        '--transcode-backend',
+        type = str,
+        choices = ["ffmpeg", "soundfile"],
+        help = "What converts files to 16 bit. 'soundfile' converts FLAC files in process with dither, without starting ffmpeg, and needs the soundfile and numpy packages. Other files always use ffmpeg.",
+    )
+    parser.add_argument(
+        '--transcode-codec',
+        type = str,
+        choices = ["keep", "flac", "opus", "aac"],
+        help = "What lossless files (FLAC, WAV, AIFF and ALAC) are stored as on the device. 'keep' keeps their format, 'flac' makes them FLAC, "
+            "'opus' and 'aac' encode them at --transcode-bitrate-kbps. Lossy files are always copied as they are.",
+    )
+    parser.add_argument(
+        '--transcode-bitrate-kbps',
+        type = int,
+        help = "Bitrate of opus and aac files. Defaults to 128 for opus and 256 for aac.",
+    )
+    parser.add_argument(
+        '--max-bit-depth',
+        type = int,
+        choices = [16, 24],
+        help = "Lossless files with a higher bit depth are converted to this. Defaults to 16.",
+    )
+    parser.add_argument(
+        '--max-sample-rate',
+        type = int,
+        help = "Lossless files with a higher sample rate are resampled, 88.2 and 176.4 kHz to 44.1 kHz and 96 and 192 kHz to 48 kHz if that is within the limit. 0 disables it.",
+    )
+    parser.add_argument(
+        '--cover-size',
+        type = int,
+        help = "Maximum width and height of the album art, in pixels. Defaults to 512.",
+    )
+    parser.add_argument(
+        '--staging-dir',
+        type = str,
+        help = "Local directory where files are converted before they are moved to the out dir. Defaults to the system temp dir.",
+    )
+    parser.add_argument(
+        '--transcode-cache-dir',
+        type = str,
+        help = "Local directory to keep converted files in, so syncing the same library to another device does not convert them again. Defaults to ~/.cache/PlexPlaylistSync/transcodes.",
+    )
+    parser.add_argument(
+        '--transcode-cache-max-gb',
+        type = float,
+        help = "Maximum size of the transcode cache in GB, the least recently used files are removed when it is full. 0 disables the cache.",
+    )
+    parser.add_argument(
+        '--copy-buffer-mb',
+        type = int,
+        help = "Size of the reads and writes when copying files. Large buffers keep the SMB share and flash drive busy with sequential transfers.",
+    )
+    parser.add_argument(
+        '--read-ahead',
+        type = int,
+        help = "Amount of files read ahead from the SMB share into the staging dir while earlier files are written to the out dir. 0 disables it.",
+    )
+    parser.add_argument(
+        '--fsync',
+        type = str,
+        choices = ["file", "album", "end", "none"],
+        help = "When written files are flushed to the out dir: after every file, per album folder, once at the end of the sync, or never (left to the OS).",
+    )
+    parser.add_argument(
+        '--smb-username',
+        type = str,
+        help = "User to log in to the SMB server with, if fs-music-root is an smb://server/share/path url. Needs the smbprotocol package.",
+    )
+    parser.add_argument(
+        '--smb-password',
+        type = str,
+        help = "Password of --smb-username.",
+    )
+    parser.add_argument(
+        '--prune-cache',
+        action = 'store_true',
+        default = None,
+        help = "Removes entries of files that no longer exist from the probe cache. Only applies to this run.",
+    )
+    parser.add_argument(
+        '--dry-run',
+        action = 'store_true',
+        default = None,
+        help = "Prints what the sync would copy, convert and delete, with byte totals, without changing anything. Only applies to this run.",
+    )
+    parser.add_argument(
+        '--profile',
+        type = str,
+        choices = ["cprofile", "pyinstrument"],
+        help = "Profiles the sync and stores the profile next to the config. cprofile also profiles the worker threads, pyinstrument only the main thread and needs to be installed. Only applies to this run.",
+    )
     return parser.parse_args()
 
+@contextlib.contextmanager
+def timed_phase(timings, name):
+    """Add the seconds spent in the with block to timings[name], if timings is not None."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + time.perf_counter() - start_time
+
 def get_machine_name():
     return socket.gethostname()
 
@@ -107,7 +294,7 @@ def load_config(output_dir):
 
 
 def update_config(config_path, config, args):
-    new_values = {k: v for k, v in vars(args).items() if v is not None and k != "out_dir"}
+    new_values = {k: v for k, v in vars(args).items() if v is not None and k not in RUN_ONLY_ARGS}
     if not new_values:
         return
 
@@ -136,52 +323,108 @@ def get_minute_rounded_mtime(filepath):
     """Get the file modification time rounded to the nearest minute."""
     return int(os.path.getmtime(filepath) // 60)  # Round down to minute precision
 
-def copy_file_if_newer(src, dst):
-    copy = should_copy_file_if_newer(src, dst)
-    if copy:
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.copy2(src, dst)  # Copies metadata including timestamps
-
-    return copy
-
-def should_copy_file_if_newer(src, dst):
-    if not os.path.exists(src):
-        raise FileNotFoundError(f"Source file does not exist: {src}")
-    
-    if os.path.exists(dst):
-        src_mtime = get_minute_rounded_mtime(src)
-        dst_mtime = get_minute_rounded_mtime(dst)
-
-        if src_mtime <= dst_mtime:
-            return False  # No need to copy
+COPY_BUFFER_SIZE = 1024 * 1024
 
-    return True # file should be copied
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        while chunk := file.read(COPY_BUFFER_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def copy_modification_time(src, dst):
     mod_time = get_minute_rounded_mtime(src)
     os.utime(dst, (mod_time, mod_time))
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_PROGRESSIVE_SOF_MARKERS = {0xC2, 0xC6, 0xCA, 0xCE}   # same as what PIL reports as progressive
+
+def parse_image_header(image_data):
+    """Read image dimensions, format, and whether a JPEG is progressive straight from the JPEG or PNG header.
+    Works on a memoryview of image_data, so nothing is copied or decoded. Returns None if the header cannot be parsed."""
+    data = memoryview(image_data)
+    size = len(data)
+
+    if data[:8] == PNG_SIGNATURE and data[12:16] == b'IHDR' and size >= 24:
+        width, height = struct.unpack_from('>II', data, 16)
+        return (width, height), "PNG", False
+
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    pos = 2
+    while pos + 4 <= size:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:   # markers without a length
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):  # end of image or start of scan before the frame header
+            return None
+
+        length = struct.unpack_from('>H', data, pos + 2)[0]
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 9 > size:
+                return None
+            height, width = struct.unpack_from('>HH', data, pos + 5)
+            return (width, height), "JPEG", marker in JPEG_PROGRESSIVE_SOF_MARKERS
+        pos += 2 + length
+
+    return None
+
 def get_image_dimensions_format_and_progressive(image_data):
     """Extract image dimensions, format, and check if JPEG is progressive."""
+    header = parse_image_header(image_data)
+    if header is not None:
+        return header
+
     with Image.open(io.BytesIO(image_data)) as img:
-        is_progressive = "progressive" in img.info
-        return img.size, img.format, is_progressive
+        return get_opened_image_dimensions_format_and_progressive(img)
+
+def get_opened_image_dimensions_format_and_progressive(img):
+    """Same as above for an image that is already opened with PIL, for formats the header parser does not know."""
+    is_progressive = "progressive" in img.info
+    return img.size, img.format, is_progressive
 
 MAX_SIZE = 512
-def convert_album_art_image_baseline_jpeg(image_data, filepath):
-    (width, height), img_format, is_progressive = get_image_dimensions_format_and_progressive(image_data)
-    
-    if max(width, height) <= MAX_SIZE and img_format == "JPEG" and not is_progressive:
-        # print(f"- {os.path.basename(filepath)}... OK!")
-        return image_data  # Skip processing if already within limits and baseline JPEG
-    
+def is_baseline_jpeg_within_max_size(header, maxSize = MAX_SIZE):
+    (width, height), img_format, is_progressive = header
+    return max(width, height) <= maxSize and img_format == "JPEG" and not is_progressive
+
+def convert_album_art_image_baseline_jpeg(image_data, artCache = None, maxSize = MAX_SIZE):
+    """Returns image_data as baseline JPEG of at most maxSize, or image_data itself if it already is one.
+    With an artCache (see cache.ArtCache) every distinct image is only converted once per size."""
+    header = parse_image_header(image_data)
+    if header is not None and is_baseline_jpeg_within_max_size(header, maxSize):
+        return image_data  # Skip processing if already within limits and baseline JPEG, PIL is not needed for that
+
+    if artCache is not None:
+        key = artCache.key(image_data, maxSize)
+        cached = artCache.get(key)
+        if cached is not None:
+            return cached if cached else image_data     # empty means the original was fine
+
     with Image.open(io.BytesIO(image_data)) as img:
-        img = img.convert("RGB")
-        img.thumbnail((MAX_SIZE, MAX_SIZE))
-        output = io.BytesIO()
-        img.save(output, format="JPEG", quality=85, progressive=False)
-        print(f"- {os.path.basename(filepath)}... Converted.")
-        return output.getvalue()
+        if header is None:
+            header = get_opened_image_dimensions_format_and_progressive(img)
+
+        if is_baseline_jpeg_within_max_size(header, maxSize):
+            result = image_data
+        else:
+            img = img.convert("RGB")
+            img.thumbnail((maxSize, maxSize))
+            output = io.BytesIO()
+            img.save(output, format="JPEG", quality=85, progressive=False)
+            result = output.getvalue()
+
+    if artCache is not None:
+        artCache.put(key, b"" if result is image_data else result)
+    return result
 
 def is_gvfs_smb_share(path):
     """Check if the path is a GVfs-mounted SMB share."""
@@ -240,70 +483,138 @@ def ensure_access_to_folder(path):
     else:
         return True # no log, not a gvfs share
 
-def get_bit_depth(file_path):
-    # First get the codec
-    codec_cmd = [
-        'ffprobe', '-v', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=codec_name',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        file_path
-    ]
-    codec_result = subprocess.run(codec_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    codec = codec_result.stdout.strip()
-
-    # Skip conversion for lossy formats
-    lossy_codecs = ['aac', 'mp3', 'opus', 'vorbis']
-    if codec in lossy_codecs:
-        return None
-
-    # Try bits_per_raw_sample
+LOSSY_CODECS = ['aac', 'mp3', 'opus', 'vorbis']
+SAMPLE_FMT_TO_BIT_DEPTH = {
+    's16': 16,
+    's16p': 16,
+    's24': 24,
+    's32': 32,
+    'flt': 32,
+    'dbl': 64,
+}
+
+class AudioProbe(Config):
+    """Result of probing an audio file: codec, bit_depth, sample_fmt, sample_rate, channels, duration and has_art.
+    bit_depth is None for lossy codecs, as those are never converted."""
+    pass
+
+def probe_audio_ffprobe(file_path):
+    """Probe the first audio stream of a file with a single ffprobe call."""
     cmd = [
         'ffprobe', '-v', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=bits_per_raw_sample',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
+        '-show_streams', '-show_format',
+        '-of', 'json',
         file_path
     ]
     result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    raw = result.stdout.strip()
+    try:
+        data = json.loads(result.stdout)
+    except ValueError:
+        return None
 
-    if raw and raw != 'N/A':
-        try:
-            return int(raw)
-        except ValueError:
-            pass
+    streams = data.get('streams', [])
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    if audio is None:
+        return None
 
-    # Fallback: sample_fmt
-    cmd2 = [
-        'ffprobe', '-v', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=sample_fmt',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        file_path
-    ]
-    result2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    fmt = result2.stdout.strip()
+    codec = audio.get('codec_name')
+    sample_fmt = audio.get('sample_fmt')
+    bit_depth = None
+    if codec not in LOSSY_CODECS:
+        try:
+            bit_depth = int(audio.get('bits_per_raw_sample'))
+        except (TypeError, ValueError):
+            bit_depth = SAMPLE_FMT_TO_BIT_DEPTH.get(sample_fmt, None)
+
+    duration = audio.get('duration') or data.get('format', {}).get('duration')
+    return AudioProbe(
+        codec = codec,
+        bit_depth = bit_depth,
+        sample_fmt = sample_fmt,
+        sample_rate = int(audio['sample_rate']) if audio.get('sample_rate') else None,
+        channels = audio.get('channels'),
+        duration = float(duration) if duration else None,
+        has_art = any(stream.get('disposition', {}).get('attached_pic') == 1 for stream in streams),
+    )
 
-    sample_fmt_to_bit_depth = {
-        's16': 16,
-        's16p': 16,
-        's24': 24,
-        's32': 32,
-        'flt': 32,
-        'dbl': 64,
-    }
+def probe_audio_mutagen(file_path, fileobj = None):
+    """Probe an audio file by only reading its headers with mutagen, without starting a process.
+    Reads from fileobj instead of opening file_path if it is given.
+    Returns None for unsupported or unreadable files, so the caller can fall back to ffprobe."""
+    ext = os.path.splitext(file_path)[1].lower()
+    filething = fileobj or file_path
+    try:
+        if ext == ".flac":
+            audio = FLAC(filething)
+            codec, bit_depth, has_art = 'flac', audio.info.bits_per_sample, bool(audio.pictures)
+        elif ext == ".mp3":
+            audio = MP3(filething)
+            codec, bit_depth = 'mp3', None
+            has_art = audio.tags is not None and any(key.startswith("APIC") for key in audio.tags.keys())
+        elif ext == ".m4a":
+            audio = MP4(filething)
+            if audio.info.codec == 'alac':
+                codec, bit_depth = 'alac', audio.info.bits_per_sample
+            elif audio.info.codec.startswith('mp4a'):
+                codec, bit_depth = 'aac', None
+            else:
+                codec, bit_depth = audio.info.codec.lower(), None  # like opus, ffprobe names it the same
+            has_art = audio.tags is not None and "covr" in audio.tags
+        elif ext == ".wav":
+            audio = WAVE(filething)
+            codec, bit_depth, has_art = 'pcm', audio.info.bits_per_sample, False
+        elif ext == ".opus":
+            audio = OggOpus(filething)
+            codec, bit_depth = 'opus', None
+            has_art = audio.tags is not None and "metadata_block_picture" in audio.tags
+        else:
+            return None
+    except MutagenError:
+        return None
 
-    return sample_fmt_to_bit_depth.get(fmt, None)
+    return AudioProbe(
+        codec = codec,
+        bit_depth = bit_depth,
+        sample_fmt = None,
+        sample_rate = getattr(audio.info, "sample_rate", 48000),  # opus has none, it always decodes to 48 kHz
+        channels = audio.info.channels,
+        duration = audio.info.length,
+        has_art = has_art,
+    )
 
-def convert_to_16bit(input_path, output_path):
+def probe_audio(file_path, fast = True, fileSystem = None):
+    """Probe an audio file, using the mutagen header parser if fast is set and ffprobe otherwise (or as fallback).
+    Files that only fileSystem can open are read through it, ffprobe gets a temporary local copy of those."""
+    if fileSystem is None or fileSystem.is_local(file_path):
+        if fast:
+            probe = probe_audio_mutagen(file_path)
+            if probe is not None:
+                return probe
+        return probe_audio_ffprobe(file_path)
+
+    if fast:
+        with fileSystem.open(file_path) as file:
+            probe = probe_audio_mutagen(file_path, file)
+        if probe is not None:
+            return probe
+    fd, local_path = tempfile.mkstemp(suffix=os.path.splitext(file_path)[1])
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in fileSystem.read_chunks(file_path, COPY_BUFFER_SIZE):
+                file.write(chunk)
+        return probe_audio_ffprobe(local_path)
+    finally:
+        os.remove(local_path)
+
+def convert_audio(input_path, output_path, options):
+    """Convert input_path to output_path with ffmpeg, options are the output options like codec and sample format."""
     os.makedirs(os.path.dirname(output_path), exist_ok=True)    # ensure the output directory exists
 
     cmd = [
         'ffmpeg',
         '-y',   # This tells FFmpeg: "yes, overwrite existing files"
         '-i', input_path,
-        '-sample_fmt', 's16',  # Set sample format to 16-bit
+        *options,
         output_path
     ]
 